@@ -0,0 +1,286 @@
+import sys
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import cpu_count, environ
+from pathlib import Path
+from platform import python_version
+from shutil import copyfile, rmtree
+from statistics import median
+from tempfile import gettempdir
+from time import perf_counter
+
+from optimizeAV import addStats, getStats
+from src.ffHelpers import getMeta
+from src.helpers import now, prefixDots, round2
+from src.osHelpers import checkPaths, getFileList, log, readJsonl, runCmd
+from src.pkgState import setCacheDir
+from src.statHelpers import RunStats
+
+benchRes = {240: 426, 480: 854, 720: 1280}
+
+benchDurs = (5, 15)
+
+benchContainers = {".mp4": "aac", ".mkv": "libopus", ".mov": "aac"}
+
+secs = lambda val: f"{val:.4f}s"
+
+
+def cliArgs(parser):
+    parser.add_argument(
+        "-wd",
+        "--workDir",
+        default=Path(gettempdir()) / "ffuBench",
+        type=Path,
+        help="Directory for fixtures, tool outputs and caches; fixtures are "
+        "reused across runs. (default: <tmp>/ffuBench)",
+    )
+    parser.add_argument(
+        "-rp",
+        "--repeat",
+        default=5,
+        type=int,
+        help="Repetitions of each micro-benchmark. (default: 5)",
+    )
+    parser.add_argument(
+        "-rn",
+        "--runs",
+        default=1,
+        type=int,
+        help="Repetitions of each end to end tool run. (default: 1)",
+    )
+    parser.add_argument(
+        "-op",
+        "--output",
+        default=None,
+        type=Path,
+        help="Results JSON file. (default: <workDir>/bench_<date>.json)",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        default=None,
+        type=Path,
+        help="Results JSON from an earlier run to compare against.",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        default=10,
+        type=float,
+        help="Slowdown in percent over the baseline reported as a regression; "
+        "exits with 1 if any. (default: 10)",
+    )
+    parser.add_argument(
+        "-me",
+        "--micro",
+        action="store_true",
+        help="Only run micro-benchmarks and skip end to end tool runs.",
+    )
+    return parser
+
+
+def fixtureCmd(ffmpegPath, outFile, dur, res=None, aCodec="aac"):
+    lavfi = lambda src: ["-f", "lavfi", "-i", src]
+    video = (
+        [
+            *lavfi(f"testsrc2=size={benchRes[res]}x{res}:rate=30:duration={dur}"),
+            *lavfi(f"sine=frequency=440:sample_rate=48000:duration={dur}"),
+            *("-map", "0:v", "-map", "1:a"),
+            *("-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"),
+        ]
+        if res
+        else lavfi(f"sine=frequency=440:sample_rate=48000:duration={dur}")
+    )
+    return [
+        ffmpegPath,
+        *video,
+        *("-c:a", aCodec, "-b:a", "96k"),
+        *("-fflags", "+bitexact", "-flags", "+bitexact", "-map_metadata", "-1"),
+        *("-loglevel", "24", "-nostdin", "-y", str(outFile)),
+    ]
+
+
+def makeFixtures(ffmpegPath, mediaDir):
+    # deterministic lavfi sources, so existing fixtures are safe to reuse
+    mediaDir.mkdir(parents=True, exist_ok=True)
+    exts = list(benchContainers)
+    specs = [
+        (f"{res}p_{dur}s{exts[i % len(exts)]}", dur, res)
+        for i, (res, dur) in enumerate((r, d) for r in benchRes for d in benchDurs)
+    ]
+    specs += [(f"audio_{dur}s.m4a", dur, None) for dur in benchDurs]
+    for name, dur, res in specs:
+        outFile = mediaDir / name
+        if not outFile.exists():
+            aCodec = benchContainers.get(outFile.suffix, "aac")
+            runCmd(fixtureCmd(ffmpegPath, outFile, dur, res, aCodec))
+    return [mediaDir / name for name, _, _ in specs]
+
+
+def makeTree(treeDir, dirs=50, files=40):
+    exts = (".mp4", ".txt", ".mkv", ".jpg")
+    if treeDir.exists():
+        return treeDir
+    for d in range(dirs):
+        sub = treeDir / f"d{d // 10}" / f"d{d}"
+        sub.mkdir(parents=True, exist_ok=True)
+        for f in range(files):
+            (sub / f"f{f}{exts[f % len(exts)]}").touch()
+    return treeDir
+
+
+def timeIt(func, repeat):
+    times = []
+    for _ in range(repeat):
+        strt = perf_counter()
+        func()
+        times.append(perf_counter() - strt)
+    return {"runs": times, "min": min(times), "median": median(times)}
+
+
+def toolCmd(tool, mediaDir):
+    toolArgs = {
+        "checkMedia": [],
+        "optimizeAV": [
+            *("-ca", "opus", "-s", "ultrafast"),
+            *("-ml", "1000", "-mt", "1000", "-mm", "0"),
+        ],
+        "takeSamples": ["-l", "2", "-s", "2"],
+    }
+    return [
+        sys.executable,
+        str(Path(__file__).parent / f"{tool}.py"),
+        str(mediaDir),
+    ] + toolArgs[tool]
+
+
+def cleanOutputs(mediaDir):
+    rmtree(mediaDir / f"out_{mediaDir.name}", ignore_errors=True)
+    for f in mediaDir.glob("trm_*"):
+        f.unlink()
+
+
+def runTool(tool, mediaDir, cacheDir):
+    # every run starts from empty outputs and a cold probe cache
+    cleanOutputs(mediaDir)
+    rmtree(cacheDir, ignore_errors=True)
+    environ["FFU_CACHE_DIR"] = str(cacheDir)
+    runCmd(toolCmd(tool, mediaDir))
+
+
+def benchTools(mediaDir, cacheDir, jrnlFile, runs):
+    results = {}
+    for tool in ("checkMedia", "optimizeAV", "takeSamples"):
+        log(f"Running {tool} end to end.")
+        results[f"e2e.{tool}"] = timeIt(lambda: runTool(tool, mediaDir, cacheDir), runs)
+        if tool == "optimizeAV":
+            # kept as input for the getStats micro-benchmark
+            outDir = mediaDir / f"out_{mediaDir.name}"
+            copyfile(outDir / f"jrnl_{mediaDir.name}.jsonl", jrnlFile)
+    cleanOutputs(mediaDir)
+    return results
+
+
+def benchStats(jrnlFile, repeat):
+    records = [r for r in readJsonl(jrnlFile) if "input" in r]
+
+    def statsLoop():
+        stats = RunStats()
+        for rcd in records * 50:
+            getStats(addStats(stats, rcd), rcd, len(records))
+
+    return timeIt(statsLoop, repeat)
+
+
+def benchMicro(ffprobePath, fixtures, treeDir, cacheDir, repeat):
+    getMetas = lambda: [getMeta(ffprobePath, f, ("video", "audio")) for f in fixtures]
+
+    setCacheDir(None)
+    results = {"micro.getMeta.uncached": timeIt(getMetas, repeat)}
+    setCacheDir(cacheDir)
+    getMetas()
+    results["micro.getMeta.cached"] = timeIt(getMetas, repeat)
+
+    exts = prefixDots(("mp4", "mkv"))
+    getFiles = lambda: getFileList(treeDir, exts, True)
+    setCacheDir(None)
+    results["micro.getFileList"] = timeIt(getFiles, repeat)
+    setCacheDir(cacheDir)
+    getFiles()
+    results["micro.getFileList.snapshot"] = timeIt(getFiles, repeat)
+    return results
+
+
+def compareBaseline(results, baseline, tolerance):
+    rows, regressed = [], []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base:
+            rows.append(f"{name}: {secs(res['min'])} (new)")
+            continue
+        change = (res["min"] - base["min"]) / max(base["min"], 1e-9) * 100
+        if change > tolerance:
+            regressed.append(name)
+        rows.append(
+            f"{name}: {secs(base['min'])} -> {secs(res['min'])}"
+            f" ({'+' if change >= 0 else ''}{round2(change)}%)"
+            f"{' REGRESSION' if name in regressed else ''}"
+        )
+    return ("\n".join(rows), regressed)
+
+
+def main(pargs):
+    ffprobePath, ffmpegPath = checkPaths(
+        {
+            "ffprobe": r"D:\PortableApps\bin\ffprobe.exe",
+            "ffmpeg": r"D:\PortableApps\bin\ffmpeg.exe",
+        }
+    )
+
+    workDir = pargs.workDir.resolve()
+    mediaDir, cacheDir = workDir / "media", workDir / "cache"
+    log(f"Preparing fixtures in {workDir}.")
+    fixtures = makeFixtures(ffmpegPath, mediaDir)
+    treeDir = makeTree(workDir / "tree")
+
+    jrnlFile = workDir / "jrnl_optimizeAV.jsonl"
+
+    results = {}
+    if not pargs.micro:
+        results.update(benchTools(mediaDir, cacheDir, jrnlFile, pargs.runs))
+
+    results.update(benchMicro(ffprobePath, fixtures, treeDir, cacheDir, pargs.repeat))
+    if jrnlFile.exists():
+        results["micro.getStats"] = benchStats(jrnlFile, pargs.repeat)
+
+    report = {
+        "meta": {
+            "date": now(),
+            "python": python_version(),
+            "ffmpeg": runCmd([ffmpegPath, "-version"]).splitlines()[0],
+            "cpus": cpu_count(),
+        },
+        "results": results,
+    }
+    outFile = pargs.output or workDir / f"bench_{now()[:10]}.json"
+    outFile.write_text(dumps(report, indent=2))
+
+    if pargs.baseline:
+        baseline = loads(pargs.baseline.read_text())["results"]
+        table, regressed = compareBaseline(results, baseline, pargs.tolerance)
+        log(f"\n{table}\n\nResults: {outFile}")
+        if regressed:
+            sys.exit(1)
+    else:
+        log(
+            "\n"
+            + "\n".join(f"{k}: {secs(v['min'])}" for k, v in results.items())
+            + f"\n\nResults: {outFile}"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark ffUtils tools on generated media fixtures."
+    )
+    main(cliArgs(parser).parse_args())
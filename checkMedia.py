@@ -1,58 +1,130 @@
 from argparse import ArgumentParser
-from statistics import fmean, mode
 
-from src.cliHelpers import addCliDir, addCliRec, addCliExt
-from src.ffHelpers import getFormatKeys, getMetaData
-from src.helpers import collectAtIndex, emap, readableSize, readableTime, round2
-from src.osHelpers import checkPath, exitIfEmpty, getFileList
+from src.cacheHelpers import cacheSummary
+from src.cliHelpers import (
+    addCliDir,
+    addCliExt,
+    addCliProbeJobs,
+    addCliProm,
+    addCliRec,
+)
+from src.ffHelpers import getFormatKeys, probeFiles
+from src.helpers import (
+    dictToNspace,
+    readableDict,
+    readableSize,
+    readableTime,
+    round2,
+)
+from src.osHelpers import checkPath, exitIfEmpty, iterFileList
+from src.stageHelpers import StageTimer, readableStages, stageKeys, writeProm
+from src.statHelpers import Reservoir, RunningStat, RunStats, StreamMode
 
 
 def cliArgs(parser):
     parser = addCliDir(parser)
     parser = addCliRec(parser)
     parser = addCliExt(parser, (".mp4", ".mov"))
+    parser = addCliProbeJobs(parser)
+    parser = addCliProm(parser)
+    parser.add_argument(
+        "-u",
+        "--update",
+        default=1000,
+        type=int,
+        help="Print a partial summary every N files, 0 to disable. (default: 1000)",
+    )
 
     return parser
 
 
-def main(pargs):
-    ffprobePath = checkPath("ffprobe", r"D:\PortableApps\bin\ffprobe.exe")
-
-    fileList = getFileList(pargs.dir.resolve(), pargs.extensions, pargs.recursive)
-
-    exitIfEmpty(fileList)
+def makeAggs():
+    return dictToNspace(
+        {
+            "files": 0,
+            "durations": RunningStat(),
+            "bitRates": RunningStat(),
+            "durationQs": Reservoir(),
+            "bitRateQs": Reservoir(),
+            "streams": StreamMode(),
+        }
+    )
 
-    metaData = [getMetaData(ffprobePath, f) for f in fileList]
 
+def addFormat(aggs, metaData):
     keys = ("duration", "bit_rate", "nb_streams")
+    fmt = getFormatKeys(metaData, keys, asDict=True)
+    aggs.files += 1
+    aggs.durations.add(fmt.get("duration"))
+    aggs.durationQs.add(fmt.get("duration"))
+    aggs.bitRates.add(fmt.get("bit_rate"))
+    aggs.bitRateQs.add(fmt.get("bit_rate"))
+    aggs.streams.add(fmt.get("nb_streams") and int(fmt["nb_streams"]))
+    return aggs
+
+
+def getSummary(aggs, partial=False):
+    durQs = aggs.durationQs.quantiles()
+    bitQs = aggs.bitRateQs.quantiles()
+    return (
+        f"\n{'Partial c' if partial else 'C'}ontainer format summary"
+        f" for {aggs.files} files:\n"
+        f"Sum Duration: {readableTime(round2(aggs.durations.total))}\n"
+        f"Mean Duration: {readableTime(round2(aggs.durations.mean))}\n"
+        f"Sum Bit Rate: {readableSize(round2(aggs.bitRates.total))}\n"
+        f"Mean Bit Rate: {readableSize(round2(aggs.bitRates.mean))}\n"
+        f"Mode Number of Streams: {aggs.streams.mode}\n"
+        f"Duration Quantiles:: "
+        f"p10: {readableTime(durQs[0])}, p50: {readableTime(durQs[1])}"
+        f" & p90: {readableTime(durQs[2])}\n"
+        f"Bit Rate Quantiles:: "
+        f"p10: {readableSize(bitQs[0])}, p50: {readableSize(bitQs[1])}"
+        f" & p90: {readableSize(bitQs[2])}"
+    )
 
-    formatData = [emap(float, getFormatKeys(m, keys)) for m in metaData]
-
-    durations = collectAtIndex(formatData, 0)
-
-    bitRates = collectAtIndex(formatData, 1)
-
-    streams = collectAtIndex(formatData, 2)
-
-    sumDur = round2(sum(durations))
-
-    meanDur = round2(fmean(durations))
-
-    sumBitR = round2(sum(bitRates))
-
-    meanBitR = round2(fmean(bitRates))
-
-    modeStreams = mode(streams)
 
-    print(
-        f"\nContainer format summary for {len(formatData)} files:\n"
-        f"Sum Duration: {readableTime(sumDur)}\n"
-        f"Mean Duration: {readableTime(meanDur)}\n"
-        f"Sum Bit Rate: {readableSize(sumBitR)}\n"
-        f"Mean Bit Rate: {readableSize(meanBitR)}\n"
-        f"Mode Number of Streams: {int(modeStreams)}"
+def main(pargs):
+    ffprobePath = checkPath("ffprobe", r"D:\PortableApps\bin\ffprobe.exe")
+    timer = StageTimer()
+    stageStats = lambda: RunStats().add(**stageKeys(timer.stages))
+
+    fileList = iterFileList(
+        pargs.dir.resolve(),
+        pargs.extensions,
+        pargs.recursive,
+        pargs.exclude,
+        pargs.followLinks,
     )
 
+    aggs, failed = makeAggs(), 0
+    addFormatT = timer.timed("aggregate")(addFormat)
+    probed = probeFiles(ffprobePath, fileList, pargs.probeJobs)
+    while True:
+        # listing runs lazily inside the probe feed, so it is part of "probe"
+        with timer.stage("probe"):
+            file, meta = next(probed, (None, None))
+        if file is None:
+            break
+        if isinstance(meta, Exception):
+            print(f"WARNING: Failed to probe {file}: {meta}")
+            failed += 1
+            continue
+        addFormatT(aggs, meta)
+        if pargs.update and aggs.files % pargs.update == 0:
+            print(getSummary(aggs, partial=True))
+            if pargs.prom:
+                writeProm(pargs.prom, "checkMedia", stageStats(), aggs.files, failed)
+
+    exitIfEmpty(aggs.files)
+
+    with timer.stage("summary"):
+        summary = getSummary(aggs)
+    print(summary)
+    print(f"Stage totals:: {readableDict(readableStages(stageStats()))}")
+    print(cacheSummary())
+    if pargs.prom:
+        writeProm(pargs.prom, "checkMedia", stageStats(), aggs.files, failed)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(
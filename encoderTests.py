@@ -1,48 +1,62 @@
 from argparse import ArgumentParser
-from statistics import fmean
-from functools import reduce
+from csv import DictWriter
+from itertools import product
+from json import dumps
 
 from src.cliHelpers import (
     addCliDir,
     addCliDry,
     addCliExt,
+    addCliJobs,
+    addCliMetrics,
     addCliOnly,
     addCliRec,
     checkValIn,
 )
 from src.ffHelpers import (
+    audioCfg,
+    ffCmdOpts,
     getffmpegCmd,
-    getSlctMeta,
-    optsVideo,
-    readableKeys,
-    selectCodec,
+    getMeta,
+    getMetrics,
+    readableScores,
+    videoCfg,
 )
 from src.helpers import (
-    appendFile,
-    checkPaths,
-    emap,
-    exitIfEmpty,
-    getFileList,
+    csvToList,
     readableDict,
     readableSize,
     readableTime,
     round2,
-    runCmd,
+    strSum,
     trackTime,
 )
+from src.jobHelpers import isolate, poolMap
+from src.osHelpers import (
+    checkPaths,
+    exitIfEmpty,
+    getFileList,
+    log,
+    makeTargetDir,
+    runCmdProgress,
+)
+from src.pkgState import setLogFile
+from src.statHelpers import RunStats
 
+optList = lambda typ: lambda vals: [typ(v) for v in csvToList(vals)]
 
-def parseArgs():
 
-    aCodec = lambda v: checkValIn(v, ["opus", "he", "aac", "ac"], str)
-    vCodec = lambda v: checkValIn(v, ["avc", "hevc", "av1", "vn", "vc"], str)
+def cliArgs(parser):
+    vCodecs = ["avc", "hevc", "av1"]
+    aCodecs = ["opus", "he", "aac", "ac"]
 
-    parser = ArgumentParser(description="FFmpeg Video/Audio Encoder testing.")
     parser = addCliDir(parser)
     parser = addCliRec(parser)
     parser = addCliDry(parser)
     parser = addCliOnly(parser)
     parser = addCliExt(parser, (".mp4", ".mov"))
+    parser = addCliJobs(parser)
+    parser = addCliMetrics(parser)
     parser.add_argument(
         "-rs",
         "--res",
@@ -63,38 +77,36 @@ def parseArgs():
             " (default: 30, disable: 0)"
         ),
     )
-    parser.add_argument(
-        "-s",
-        "--speed",
-        default=None,
-        type=str,
-        help="Video encoding speed; avc & hevc: slow, medium and fast etc; "
-        "av1: 0-13/6-8 (lower is slower and efficient). "
-        "(defaults:: avc: slow, hevc: medium and av1: 8)",
-    )
-    parser.add_argument(
-        "-ca",
-        "--cAudio",
-        default="he",
-        type=aCodec,
-        help='Select an audio codec from AAC-LC: "aac", HE-AAC/AAC-LC with SBR: "he" '
-        ', Opus: "opus" and copy: "ac". (default: he)',
-    )
     parser.add_argument(
         "-cv",
         "--cVideo",
-        default="hevc",
-        type=vCodec,
-        help='Select a video codec from HEVC/H265: "hevc", AVC/H264: "avc" , '
-        'AV1: "av1", copy: "vc" and no video: "vn". (default: hevc)',
+        default=["hevc"],
+        type=optList(lambda v: checkValIn(v, vCodecs, str)),
+        help=f"Comma separated video codecs from {', '.join(vCodecs)}. "
+        "(default: hevc)",
     )
     parser.add_argument(
         "-qv",
         "--qVideo",
-        default=None,
-        type=int,
-        help="Video Quality(CRF) setting; avc:23:17-28, hevc:28:20-32 and av1:50:0-63, "
-        "lower crf means less compression. (defaults:: avc: 28, hevc: 32 and av1: 52)",
+        default=[None],
+        type=optList(int),
+        help="Comma separated Video Quality(CRF) settings. (default: codec default)",
+    )
+    parser.add_argument(
+        "-s",
+        "--speed",
+        default=[None],
+        type=optList(str),
+        help="Comma separated video encoding speeds/presets. (default: codec default)",
+    )
+    parser.add_argument(
+        "-ca",
+        "--cAudio",
+        default="ac",
+        choices=aCodecs,
+        type=str,
+        help='Audio codec used for every cell; AAC-LC: "aac", HE-AAC: "he", '
+        'Opus: "opus" and copy: "ac". (default: ac)',
     )
     parser.add_argument(
         "-qa",
@@ -103,134 +115,159 @@ def parseArgs():
         type=int,
         help="Audio Quality/bitrate in kbps; (defaults:: opus: 48, he: 56 and aac: 72)",
     )
-    return parser.parse_args()
-
+    parser.add_argument(
+        "-tf",
+        "--table",
+        default="csv",
+        choices=["csv", "json"],
+        help="Results table format. (default: csv)",
+    )
+    return parser
 
-pargs = parseArgs()
 
-ffprobePath, ffmpegPath = checkPaths(
-    {
-        "ffprobe": r"D:\PortableApps\bin\ffprobe.exe",
-        "ffmpeg": r"D:\PortableApps\bin\ffmpeg.exe",
-    }
+cellName = (
+    lambda video: f"{video.codec}_{video.quality or 'dft'}_{video.speed or 'dft'}"
 )
 
 
-def meta(cType=None):
-    basic = ["codec_type", "codec_name", "profile", "duration", "bit_rate"]
-    if cType == "audio":
-        return [*basic, "channels", "sample_rate"]
-    elif cType == "video":
-        return [*basic, "height", "r_frame_rate", "pix_fmt"]
-    else:
-        return basic
-
-
-if pargs.dry:
-    runCmd = print
-
-# Format: nb_streams, duration, bit_rate, format_name, format_long_name
-
-
-def getStats(results):
-    times = [float(x["timeTaken"]) for x in results]
-    inSizes = [float(x["input"]["size"]) for x in results]
-    # times = collectAtKey(results, ["timeTaken"])
-    # inSizes = collectAtKey(results, ["input", "size"])
-    outSizes = [float(x["output"]["size"]) for x in results]
-    lenghts = [float(x["input"]["meta"]["video"]["duration"]) for x in results]
-    VidBitsIn = [float(x["input"]["meta"]["video"]["bit_rate"]) for x in results]
-    VidBitsOut = [float(x["output"]["meta"]["video"]["bit_rate"]) for x in results]
-
-    inSum, inMean = sum(inSizes), fmean(inSizes)
-    outSum, outMean = sum(outSizes), fmean(outSizes)
-    sumTimes, meanTimes = sum(times), fmean(times)
-    sumLengths, meanLengths = sum(lenghts), fmean(lenghts)
-    VidBitsInMean, VidBitsOutMean = fmean(VidBitsIn), fmean(VidBitsOut)
-
-    return (
-        f"\n"
-        f'\nProcessed file: {results[-1]["input"]["file"].name}'
-        f'\nVideo Input:: {readableDict(readableKeys(results[-1]["input"]["meta"]["video"]))}'
-        f'\nVideo Output:: {readableDict(readableKeys(results[-1]["output"]["meta"]["video"]))}'
-        "\n\n"
-        f"Size averages:: Reduction: {round2(((inMean-outMean)/inMean)*100)}%"
-        f", Input: {(readableSize(inMean))}"
-        f" & Output: {(readableSize(outMean))}."
-        "\n"
-        f"Size totals:: Reduction: {(readableSize(inSum-outSum))}"
-        f", Input: {readableSize(inSum)}"
-        f" & Output: {readableSize(outSum)}."
-        "\n"
-        f"Processing averages:: Speed: x{round2(max(meanLengths, meanTimes)/min(meanLengths, meanTimes))}"
-        f" {'slower' if meanTimes > meanLengths else 'faster'}"
-        f", Time: {readableTime(meanTimes)}"
-        f" & Length: {readableTime(meanLengths)}."
-        "\n"
-        f"Processing totals:: Files: {len(results)}"
-        f", Time: {readableTime(sumTimes)}"
-        f" & Length: {readableTime(sumLengths)}."
-        "\n"
-        f"Video bitrate averages:: Reduction: {round2(((VidBitsInMean-VidBitsOutMean)/VidBitsInMean)*100)}%"
-        f", Input: {(readableSize(VidBitsInMean))}"
-        f" & Output: {(readableSize(VidBitsOutMean))}."
-    )
+def makeGrid(pargs):
+    return [
+        videoCfg(codec, quality, speed, pargs.res, pargs.fps)
+        for codec, quality, speed in product(pargs.cVideo, pargs.qVideo, pargs.speed)
+    ]
 
 
-def mainLoop(acc, file, dirPath, pargs, ffmpegPath, ffprobePath):
-    getSlctMetaP = lambda f, cdc: getSlctMeta(ffprobePath, f, meta(cdc), cdc, fmt=False)
-    videoMetaIn = getSlctMetaP(file, "video")
+def runCell(job, dirs, audio, ffmpegPath, pargs):
+    (file, metas), video = job
+    dirPath, outDir = dirs
+    fmtIn, videoMetaIn, audioMetaIn = metas
+    ffOpts, outExt = ffCmdOpts(audio, video, audioMetaIn, videoMetaIn)
+    # the relative path sum keeps a.mp4/a.mov and x/a.mp4/y/a.mp4 apart
+    relSum = strSum(str(file.relative_to(dirPath)))
+    outFile = outDir / f"{cellName(video)}_{file.stem}_{relSum}{outExt}"
+    cmd = getffmpegCmd(ffmpegPath, file, outFile, ffOpts)
 
-    ov = optsVideo(
-        videoMetaIn["height"], videoMetaIn["r_frame_rate"], pargs.res, pargs.fps
-    )
-    ca = selectCodec(pargs.cAudio, pargs.qAudio)
-    cv = selectCodec(pargs.cVideo, pargs.qVideo, pargs.speed)
-    fmtName = f"{(cv[1]).replace('lib', '')}_{cv[5]}_{cv[3]}"
-    outFile = file.with_name(f"{fmtName}_{file.name}")
-    logFile = dirPath / f"{fmtName}_{dirPath.name}.log"
+    if pargs.dry:
+        log(" ".join(cmd))
+        return None
 
-    cmd = getffmpegCmd(ffmpegPath, file, outFile, ca, cv, ov)
+    if outFile.exists():
+        outFile.unlink()
 
-    cmdOut, timeTaken = trackTime(lambda: runCmd(cmd))
+    label = f"{cellName(video)} {file.name}"
+    encoded, timeTaken = trackTime(
+        lambda: runCmdProgress(cmd, fmtIn.duration, label, ext=False)
+    )
+    size = outFile.stat().st_size
+    duration = encoded["outTime"] or float(fmtIn.duration or 0)
+    scores = {m: None for m in pargs.metrics}
+    if pargs.metrics:
+        scored, err = isolate(
+            getMetrics, ffmpegPath, file, outFile, pargs, fmtIn.duration, False
+        )
+        if err:
+            log(f"WARNING: Failed to compute quality metrics for {outFile}: {err}")
+        scores.update(scored or {})
+
+    return {
+        "cell": cellName(video),
+        "codec": video.codec,
+        "crf": video.quality,
+        "preset": video.speed,
+        "file": file.name,
+        "duration": round2(duration),
+        "timeTaken": round2(timeTaken),
+        "fps": round2(encoded["frames"] / timeTaken) if timeTaken else 0.0,
+        "speed": round2(duration / timeTaken) if timeTaken else 0.0,
+        "inputSize": int(fmtIn.size),
+        "outputSize": size,
+        "bitRate": int(size * 8 / duration) if duration else None,
+        **scores,
+    }
 
-    videoMetaOut = getSlctMetaP(outFile, "video")
 
-    results = [
-        *acc,
-        {
-            "cmd": cmd,
-            "timeTaken": timeTaken,
-            "input": {
-                "file": file,
-                "size": file.stat().st_size,
-                "meta": {"video": videoMetaIn},
-            },
-            "output": {
-                "file": outFile,
-                "size": outFile.stat().st_size,
-                "meta": {"video": videoMetaOut},
-            },
-        },
-    ]
+def getCellStats(rows, pargs):
+    cells = {}
+    for row in rows:
+        cells.setdefault(row["cell"], RunStats()).add(
+            timeTaken=row["timeTaken"],
+            fps=row["fps"],
+            inputSize=row["inputSize"],
+            outputSize=row["outputSize"],
+            bitRate=row["bitRate"],
+            **{m: row[m] for m in pargs.metrics},
+        )
+    return "\n".join(
+        f"{cell}:: "
+        + readableDict(
+            {
+                "Files": st["timeTaken"].count,
+                "Time": readableTime(st["timeTaken"].total),
+                "FPS": round2(st["fps"].mean),
+                "Size": readableSize(st["outputSize"].total),
+                "Ratio": round2(st["outputSize"].total / st["inputSize"].total),
+                "Bit Rate": readableSize(st["bitRate"].mean),
+                **readableScores(st),
+            }
+        )
+        for cell, st in sorted(cells.items())
+    )
 
-    stats = getStats(results)
-    print(stats)
-    appendFile(logFile, stats)
 
-    return results
+def writeTable(tableFile, rows):
+    if tableFile.suffix == ".json":
+        tableFile.write_text(dumps(rows, indent=2))
+        return tableFile
+    with open(tableFile, "w", newline="") as f:
+        writer = DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return tableFile
 
 
-def main():
+def main(pargs):
+    ffprobePath, ffmpegPath = checkPaths(
+        {
+            "ffprobe": r"D:\PortableApps\bin\ffprobe.exe",
+            "ffmpeg": r"D:\PortableApps\bin\ffmpeg.exe",
+        }
+    )
+
     dirPath = pargs.dir.resolve()
-    fileList = getFileList(dirPath, pargs.extensions)
+    outDir = dirPath / f"tests_{dirPath.name}"
+    fileList = getFileList(
+        dirPath, pargs.extensions, pargs.recursive, pargs.exclude, pargs.followLinks
+    )
+    fileList = [f for f in fileList if outDir not in f.parents]
 
     exitIfEmpty(fileList)
     if pargs.only:
         fileList = fileList[: pargs.only]
 
-    mainLoopP = lambda acc, f: mainLoop(acc, f, dirPath, pargs, ffmpegPath, ffprobePath)
-    results = reduce(mainLoopP, fileList, [])
+    makeTargetDir(outDir)
+    setLogFile(outDir / f"log_{dirPath.name}.log")
+
+    audio = audioCfg(pargs.cAudio, pargs.qAudio)
+    metas = [(f, getMeta(ffprobePath, f, ("video", "audio"))) for f in fileList]
+    jobs = list(product(metas, makeGrid(pargs)))
+    log(f"\nRunning {len(jobs)} encode(s) over {len(fileList)} file(s).")
+
+    def runCellP(job):
+        row, err = isolate(runCell, job, (dirPath, outDir), audio, ffmpegPath, pargs)
+        if row:
+            log(f"{row['cell']} {row['file']}:: {readableDict(row)}")
+        elif err:
+            (file, _), video = job
+            log(f"WARNING: {cellName(video)} {file.name} failed, left out: {err}")
+        return row
 
+    rows = [r for r in poolMap(runCellP, jobs, pargs.jobs) if r]
+    exitIfEmpty(rows)
 
-main()
+    tableFile = writeTable(outDir / f"matrix_{dirPath.name}.{pargs.table}", rows)
+    log(f"\n{getCellStats(rows, pargs)}\n\nResults table: {tableFile}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="FFmpeg Video/Audio Encoder testing.")
+    main(cliArgs(parser).parse_args())
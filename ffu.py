@@ -2,15 +2,23 @@ from argparse import ArgumentParser
 
 from checkMedia import cliArgs as cliCm
 from checkMedia import main as cm
+from encoderTests import cliArgs as cliEt
+from encoderTests import main as et
 from optimizeAV import cliArgs as cliOav
 from optimizeAV import main as oav
+from probeCache import cliArgs as cliPc
+from probeCache import main as pc
 from takeSamples import cliArgs as cliTs
 from takeSamples import main as ts
+from watchFolder import cliArgs as cliWf
+from watchFolder import main as wf
 
 parser = ArgumentParser(prog="ffUtils")
 # parser.add_argument('-v', action='store_true', help='Print version Info & exit')
 
-subparsers = parser.add_subparsers(dest="cmd", help="Various ffmpeg Utilities", required=True)
+subparsers = parser.add_subparsers(
+    dest="cmd", help="Various ffmpeg Utilities", required=True
+)
 
 parserOav = subparsers.add_parser(
     "optimizeAV",
@@ -42,11 +50,41 @@ parserTs = subparsers.add_parser(
 
 parserTs = cliTs(parserTs)
 
+parserPc = subparsers.add_parser(
+    "probeCache",
+    aliases=["p"],
+    help="Inspect, invalidate or prune the ffprobe metadata cache.",
+)
+
+parserPc = cliPc(parserPc)
+
+parserEt = subparsers.add_parser(
+    "encoderTests",
+    aliases=["e"],
+    help="FFmpeg Video/Audio Encoder testing.",
+)
+
+parserEt = cliEt(parserEt)
+
+parserWf = subparsers.add_parser(
+    "watchFolder",
+    aliases=["watch", "w"],
+    help="Watch a directory and optimize new Video/Audio files as they arrive.",
+)
+
+parserWf = cliWf(parserWf)
+
 pargs = parser.parse_args()
 
-if pargs.cmd == "optimizeAV":
+if pargs.cmd in ("optimizeAV", "o"):
     oav(pargs)
-elif pargs.cmd == "checkMedia":
+elif pargs.cmd in ("checkMedia", "c"):
     cm(pargs)
-elif pargs.cmd == "takeSamples":
+elif pargs.cmd in ("takeSamples", "s"):
     ts(pargs)
+elif pargs.cmd in ("probeCache", "p"):
+    pc(pargs)
+elif pargs.cmd in ("encoderTests", "e"):
+    et(pargs)
+elif pargs.cmd in ("watchFolder", "watch", "w"):
+    wf(pargs)
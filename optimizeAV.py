@@ -1,35 +1,53 @@
 from argparse import ArgumentParser
 from atexit import register as atexit
-from functools import reduce
-from json import dumps, loads
+from contextlib import contextmanager
+from os import cpu_count
 from pathlib import Path
-from statistics import fmean
+from threading import Event
 
 from __main__ import __file__ as mainFile
 
+from src.cacheHelpers import cacheSummary
+from src.chunkHelpers import chunkDir, encodeChunked
 from src.cliHelpers import (
     addCliDir,
     addCliExt,
+    addCliJobs,
+    addCliMetrics,
     addCliOnly,
+    addCliProbeJobs,
+    addCliProm,
     addCliRec,
+    addCliThrottle,
     addCliWait,
 )
 from src.ffHelpers import (
     audioCfg,
+    autoCopy,
     compBits,
     compDur,
+    encodeCost,
+    encodedMeta,
     ffCmdOpts,
     getffmpegCmd,
+    crfRanges,
+    efficientBpp,
     getMeta,
+    getMetrics,
+    metaDict,
+    probeFiles,
     readableMeta,
+    readableScores,
     videoCfg,
 )
 from src.helpers import (
+    dictToNspace,
     findPercentage,
-    findPercentOf,
+    nSort,
     now,
     posDivision,
     prefixDots,
+    range1,
     readableDict,
     readableSize,
     readableTime,
@@ -37,17 +55,38 @@ from src.helpers import (
     strSum,
     trackTime,
 )
+from src.jobHelpers import (
+    checkJobs,
+    defaultJobs,
+    guard,
+    isolate,
+    makeSlots,
+    prefetch,
+    pullMap,
+    sharedState,
+    startWorker,
+    stopWorker,
+    withSlot,
+)
 from src.osHelpers import (
+    appendJsonl,
     checkPaths,
     cleanUp,
     exitIfEmpty,
     getFileList,
+    jsonToJsonl,
     log,
     makeTargetDir,
-    runCmd,
+    moveVerified,
+    readJsonl,
+    runCmdProgress,
     waitN,
 )
 from src.pkgState import setLogFile
+from src.statHelpers import RunStats
+from src.sysHelpers import throttle, throttleCfg
+from src.stageHelpers import StageTimer, readableStages, stageKeys, writeProm
+from src.targetHelpers import searchCrf
 
 
 def cliArgs(parser):
@@ -63,6 +102,60 @@ def cliArgs(parser):
     parser = addCliOnly(parser)
     parser = addCliExt(parser, inExts)
     parser = addCliWait(parser)
+    parser = addCliThrottle(parser)
+    parser = addCliJobs(parser)
+    parser = addCliProbeJobs(parser)
+    parser = addCliMetrics(parser)
+    parser = addCliProm(parser)
+    parser.add_argument(
+        "-pf",
+        "--prefetch",
+        default=4,
+        type=int,
+        help="Number of files probed and planned ahead of the encoders, so a "
+        "free encoder never waits on ffprobe. (default: 4)",
+    )
+    parser.add_argument(
+        "-sc",
+        "--scratch",
+        default=None,
+        type=Path,
+        help="Write in-progress outputs to this fast local directory; finished "
+        "files are copied to the output directory in the background, verified "
+        "and atomically replaced.",
+    )
+    parser.add_argument(
+        "-or",
+        "--order",
+        default="dir",
+        choices=["dir", "name", "lpt", "spt"],
+        help="Job order; dir: directory listing order, name: natural file name "
+        "order, lpt: longest estimated encode first, which keeps all workers "
+        "busy until the end, spt: shortest first for quick feedback. lpt and spt "
+        "probe every file before the first encode starts. (default: dir)",
+    )
+    parser.add_argument(
+        "-ch",
+        "--chunks",
+        default=0,
+        type=int,
+        help="Split long videos at keyframes into N chunks that are encoded in "
+        "parallel and resumed chunk by chunk. (default: 0, disabled)",
+    )
+    parser.add_argument(
+        "-cm",
+        "--chunkMin",
+        default=30,
+        type=int,
+        help="Only chunk videos at least this many minutes long. (default: 30)",
+    )
+    parser.add_argument(
+        "-cj",
+        "--chunkJobs",
+        default=defaultJobs(),
+        type=checkJobs,
+        help=f"Number of chunks to encode in parallel. (default: {defaultJobs()})",
+    )
     parser.add_argument(
         "-rs",
         "--res",
@@ -118,6 +211,54 @@ def cliArgs(parser):
         help="Video Quality(CRF) setting; avc:23:17-28, hevc:28:20-32 and av1:50:0-63, "
         "lower crf means less compression. (defaults:: avc: 28, hevc: 32 and av1: 52)",
     )
+    parser.add_argument(
+        "-ef",
+        "--efficient",
+        default=None,
+        choices=["skip", "copy"],
+        help="Skip, or copy the video stream of, h264/hevc/av1/vp9 sources that "
+        "need no scaling and are already below --maxBpp. (default: encode all)",
+    )
+    parser.add_argument(
+        "-mb",
+        "--maxBpp",
+        default=None,
+        type=float,
+        help="Video bits per pixel per frame under which a source counts as "
+        "already efficient. (defaults:: avc: 0.08, hevc: 0.05 and av1: 0.04)",
+    )
+    parser.add_argument(
+        "-nac",
+        "--noAutoCopy",
+        action="store_true",
+        help="Always encode; by default streams already in the target codec, "
+        "within --res/--fps and at or under the target audio bitrate or "
+        "--maxBpp are copied.",
+    )
+    parser.add_argument(
+        "-tv",
+        "--targetVmaf",
+        default=None,
+        type=float,
+        help="Pick the video CRF per file by binary searching it on short samples "
+        "until their VMAF reaches this score; overrides --qVideo and needs "
+        "ffmpeg built with libvmaf. (default: disabled)",
+    )
+    parser.add_argument(
+        "-ts",
+        "--targetSamples",
+        default=4,
+        type=int,
+        help="Number of samples used for the CRF search. (default: 4)",
+    )
+    parser.add_argument(
+        "-tl",
+        "--targetLength",
+        default=5,
+        type=int,
+        help="Maximum length in seconds of each CRF search sample; shortened "
+        "further for short files. (default: 5)",
+    )
     parser.add_argument(
         "-qa",
         "--qAudio",
@@ -131,6 +272,13 @@ def cliArgs(parser):
         action="store_true",
         help="Use metadata from container format for comparison.",
     )
+    parser.add_argument(
+        "-vr",
+        "--verify",
+        action="store_true",
+        help="Probe each output with ffprobe instead of deriving its metadata "
+        "from the encode settings and ffmpeg's final progress and stats reports.",
+    )
     # parser.add_argument(
     #     "-fa",
     #     "--fAudio",
@@ -171,40 +319,50 @@ def checkBits(comp):
             )
 
 
-def getStats(results, totalFiles):
-    filesLeft = totalFiles - len(results)
-    times = [float(x["timeTaken"]) for x in results]
-    inSizes = [float(x["input"]["size"]) for x in results]
-    outSizes = [float(x["output"]["size"]) for x in results]
-    lenghts = [
-        float(x["input"]["format"]["duration"])
-        for x in results
-        if x["input"]["format"].get("duration")
-    ]
-    totalBitsIn = [
-        float(x["input"]["format"]["bits"])
-        for x in results
-        if x["input"]["format"].get("bits")
-    ]
-    totalBitsOut = [
-        float(x["output"]["format"]["bits"])
-        for x in results
-        if x["output"]["format"].get("bits")
-    ]
-
-    inSum, inMean = sum(inSizes), fmean(inSizes)
-    outSum, outMean = sum(outSizes), fmean(outSizes)
-    sumTimes, meanTimes = sum(times), fmean(times)
-    sumLengths, meanLengths = sum(lenghts), fmean(lenghts)
-    totalBitsInMean, totalBitsOutMean = fmean(totalBitsIn), fmean(totalBitsOut)
+effKeys = {"skip": "skipped", "copy": "copied"}
+
+
+def addStats(stats, result):
+    eff = result.get("efficient")
+    if eff:
+        stats.add(**{effKeys[eff["action"]]: eff["saved"]})
+    if "output" not in result:
+        return stats.add(**stageKeys(result.get("stages", {})))
+    fmtIn, fmtOut = result["input"]["format"], result["output"]["format"]
+    return stats.add(
+        timeTaken=result["timeTaken"],
+        sizeIn=result["input"]["size"],
+        sizeOut=result["output"]["size"],
+        duration=fmtIn.get("duration"),
+        bitsIn=fmtIn.get("bits"),
+        bitsOut=fmtOut.get("bits"),
+        **result.get("metrics", {}),
+        crf=result.get("crfSearch", {}).get("crf"),
+        searchTime=result.get("crfSearch", {}).get("timeTaken"),
+        **stageKeys(result.get("stages", {})),
+    )
+
+
+def getStats(stats, last, totalFiles, jobs=1):
+    times, lengths = stats["timeTaken"], stats["duration"]
+    inSizes, outSizes = stats["sizeIn"], stats["sizeOut"]
+    filesLeft = totalFiles - times.count - stats["skipped"].count
+
+    inSum, inMean = inSizes.total, inSizes.mean
+    outSum, outMean = outSizes.total, outSizes.mean
+    sumTimes, meanTimes = times.total, times.mean
+    sumLengths, meanLengths = lengths.total, lengths.mean
+    totalBitsInMean, totalBitsOutMean = stats["bitsIn"].mean, stats["bitsOut"].mean
+    lastScores = {m.upper(): v for m, v in last.get("metrics", {}).items()}
 
     return (
         f"\n"
-        f'\nProcessed file: {Path(results[-1]["input"]["file"]).name}'
+        f'\nProcessed file: {Path(last["input"]["file"]).name}'
         "\nVideo Input:: "
-        f'{readableDict(readableMeta(results[-1]["input"]["video"]))}'
+        f'{readableDict(readableMeta(last["input"]["video"]))}'
         "\nVideo Output:: "
-        f'{readableDict(readableMeta(results[-1]["output"]["video"]))}'
+        f'{readableDict(readableMeta(last["output"]["video"]))}'
+        f"{summaryLine(lastScores, 'Quality')}"
         "\n\n"
         f"Size averages:: Reduction: {findPercentage(outMean, inMean)}"
         f", Input: {(readableSize(inMean))}"
@@ -219,7 +377,7 @@ def getStats(results, totalFiles):
         f", Time: {readableTime(meanTimes)}"
         f" & Length: {readableTime(meanLengths)}."
         "\n"
-        f"Processing totals:: Files: {len(results)}"
+        f"Processing totals:: Files: {times.count}"
         f", Time: {readableTime(sumTimes)}"
         f" & Length: {readableTime(sumLengths)}."
         "\n"
@@ -231,17 +389,203 @@ def getStats(results, totalFiles):
         f"Output estimates:: Time left: "
         f"{readableTime(meanTimes * filesLeft)},"
         f" size: {readableSize(outMean * totalFiles)}"
+        "\n"
+        f"Throttling totals:: Wait: {readableTime(stats['waitTime'].total)}"
+        f" & Pauses: {stats['waitTime'].count}."
+        f"{summaryLine(readableScores(stats), 'Quality averages')}"
+        f"{crfLine(stats)}"
+        f"{effLine(stats, jobs)}"
+        f"{summaryLine(readableStages(stats), 'Stage averages')}"
+    )
+
+
+summaryLine = lambda vals, title: f"\n{title}:: {readableDict(vals)}" if vals else ""
+
+
+def effLine(stats, jobs):
+    skipped, copied = stats["skipped"], stats["copied"]
+    if not (skipped.count or copied.count):
+        return ""
+    saved = skipped.total + copied.total
+    cores = (cpu_count() or 1) / jobs  # cores each encode would have used
+    return (
+        f"\nEfficient sources:: Skipped: {skipped.count}, Copied: {copied.count}"
+        f" & Encode time saved: ~{readableTime(saved)}"
+        f" ({round2(saved * cores / 3600)} CPU-hours)."
+    )
+
+
+def skipLine(result):
+    eff = result["efficient"]
+    return (
+        f'\nSkipped file: {Path(result["input"]["file"]).name}'
+        f', already at {eff["bpp"]} bits per pixel per frame;'
+        f' ~{readableTime(eff["saved"])} of encoding saved.'
+    )
+
+
+def estEncodeTime(runState, duration):
+    # from this run's encode speed so far, real time until there is one
+    with runState.lock:
+        times, lengths = runState.stats["timeTaken"], runState.stats["duration"]
+        ratio = times.total / lengths.total if lengths.total else 1.0
+    return round2(float(duration or 0) * ratio)
+
+
+def crfLine(stats):
+    crfs, times = stats["crf"], stats["searchTime"]
+    if not crfs.count:
+        return ""
+    return (
+        f"\nCRF search:: Mean: {round2(crfs.mean)}"
+        f", Range: {int(crfs.low)}-{int(crfs.high)}"
+        f" & Time: {readableTime(times.total)}."
+    )
+
+
+def getCrf(ffPaths, file, metas, video, pargs, sampleFile):
+    (found, err), timeTaken = trackTime(
+        isolate, searchCrf, ffPaths, file, metas, video, pargs, sampleFile
+    )
+    if err:
+        log(f"WARNING: CRF search failed for {file}, using --qVideo: {err}")
+        return {}
+    if found is None:
+        log(f"\n{file.name}:: Too short for a CRF search, using --qVideo.")
+        return {}
+    crf, scores = found
+    log(f"\n{file.name}:: CRF {crf} for VMAF {pargs.targetVmaf}, samples: {scores}")
+    return {"crf": crf, "scores": scores, "timeTaken": timeTaken}
+
+
+def getScores(ffmpegPath, file, outFile, duration, pargs):
+    scores, err = isolate(getMetrics, ffmpegPath, file, outFile, pargs, duration, False)
+    if err:
+        log(f"WARNING: Failed to compute quality metrics for {outFile}: {err}")
+    return scores or {}
+
+
+def addWait(runState, waitTime):
+    if waitTime:
+        with runState.lock:
+            runState.stats.add(waitTime=waitTime)
+    return waitTime
+
+
+@contextmanager
+def activeEncode(runState):
+    # running encodes are this run's own load, which throttling leaves out
+    with runState.lock:
+        runState.active += 1
+    try:
+        yield
+    finally:
+        with runState.lock:
+            runState.active -= 1
+
+
+def useChunks(pargs, video, fmtMeta, videoMeta):
+    return (
+        pargs.chunks > 1
+        and videoMeta is not None
+        and video.codec not in ("vc", "vn")
+        and float(fmtMeta.duration or 0) >= pargs.chunkMin * 60
     )
 
 
-def mainLoop(acc, files, addFiles, AVCfg, ffPaths, pargs, totalFiles):
+def collectResult(result, runState, addFiles, pargs):
+    _, _, jrnlFile = addFiles
+    timer = StageTimer()
+    with runState.lock:
+        with timer.stage("journal"):
+            stats = addStats(runState.stats, result)
+            appendJsonl(jrnlFile, {**result, "stats": stats.toDict()})
+        stats.add(**stageKeys(timer.stages))
+        done = stats["timeTaken"].count + stats["skipped"].count
+        if "output" in result:
+            log(getStats(stats, result, runState.totalFiles, pargs.jobs))
+        else:
+            log(skipLine(result))
+        if pargs.prom:
+            writeProm(pargs.prom, "optimizeAV", stats, done)
+        return done
+
+
+def planFile(files, runState, addFiles, AVCfg, ffPaths, pargs):
+    # runs ahead of the encoders; returns None for skipped files
     file, outFile = files
-    tmpFile, logFile, jsonFile = addFiles
-    ffprobePath, ffmpegPath = ffPaths
     audio, video = AVCfg
+    timer = StageTimer()
+
+    with timer.stage("probe"):
+        fmtIn, videoMetaIn, audioMetaIn = getMeta(ffPaths[0], file, ("video", "audio"))
+
+    efficient = {}
+    bpp = pargs.efficient and efficientBpp(video, fmtIn, videoMetaIn, pargs.maxBpp)
+    if bpp:
+        saved = estEncodeTime(runState, fmtIn.duration)
+        efficient = {"action": pargs.efficient, "bpp": round(bpp, 4), "saved": saved}
+    if efficient and pargs.efficient == "skip":
+        result = {
+            "efficient": efficient,
+            "stages": timer.toDict(),
+            "input": {
+                "file": str(file),
+                "size": file.stat().st_size,
+                "format": metaDict(fmtIn),
+                "video": metaDict(videoMetaIn),
+            },
+        }
+        collectResult(result, runState, addFiles, pargs)
+        return None
+    if efficient:
+        video = videoCfg("vc", None, None, video.res, video.fps)
+
+    copied = []
+    if not pargs.noAutoCopy:
+        audio, video, copied = autoCopy(
+            (audio, video), fmtIn, audioMetaIn, videoMetaIn, pargs.maxBpp
+        )
+    if copied:
+        log(f"\n{file.name}:: Copying {' & '.join(copied)}, already on target.")
+
+    return dictToNspace(
+        {
+            "file": file,
+            "outFile": outFile,
+            "metas": (fmtIn, audioMetaIn, videoMetaIn),
+            "AVCfg": (audio, video),
+            "efficient": efficient,
+            "copied": copied,
+            "timer": timer,
+        }
+    )
 
-    getMetaP = lambda f, cdc: getMeta(ffprobePath, f, cdc)
-    fmtIn, videoMetaIn, audioMetaIn = getMetaP(file, ("video", "audio"))
+
+def encodeFile(slot, plan, runState, addFiles, ffPaths, pargs):
+    file, outFile, timer = plan.file, plan.outFile, plan.timer
+    fmtIn, audioMetaIn, videoMetaIn = plan.metas
+    audio, video = plan.AVCfg
+    ffmpegPath = ffPaths[1]
+
+    with timer.stage("throttle"):
+        # this slot's last encode and the running ones still show in the load
+        own = lambda: (runState.active + 1) / pargs.jobs
+        waitTime = 0 if pargs.wait else throttle(runState.throttle, report=log, own=own)
+        addWait(runState, waitTime)
+
+    tmpFile = slotTmpFile(addFiles[0], slot)
+    crfSearch = {}
+    if pargs.targetVmaf and videoMetaIn and video.codec in crfRanges:
+        sampleFile = tmpFile.with_name(f"smp_{tmpFile.stem}.mkv")
+        metas = (fmtIn, videoMetaIn)
+        with timer.stage("crfSearch"), activeEncode(runState):
+            crfSearch = getCrf(ffPaths, file, metas, video, pargs, sampleFile)
+    if crfSearch:
+        video = videoCfg(
+            video.codec, crfSearch["crf"], video.speed, video.res, video.fps
+        )
+    AVCfg = (audio, video)
 
     ffOpts, outExt = ffCmdOpts(
         audio,
@@ -257,52 +601,216 @@ def mainLoop(acc, files, addFiles, AVCfg, ffPaths, pargs, totalFiles):
 
     cmd = getffmpegCmd(ffmpegPath, file, tmpFile, ffOpts)
 
-    cmdOut, timeTaken = trackTime(runCmd, cmd)
+    with timer.stage("encode"), activeEncode(runState):
+        if useChunks(pargs, video, fmtIn, videoMetaIn):
+            workDir = chunkDir(tmpFile.parent, file, AVCfg, audioMetaIn, videoMetaIn)
+            encoded, timeTaken = trackTime(
+                encodeChunked,
+                ffmpegPath,
+                file,
+                tmpFile,
+                workDir,
+                AVCfg,
+                plan.metas,
+                pargs.chunks,
+                pargs.chunkJobs,
+            )
+        else:
+            encoded, timeTaken = trackTime(
+                runCmdProgress, cmd, fmtIn.duration, file.name
+            )
 
-    if pargs.recursive and not outFile.parent.exists():
-        outFile.parent.mkdir(parents=True)
-    tmpFile.rename(outFile)
+    with timer.stage("rename"):
+        if pargs.scratch:
+            # stays on scratch until the mover copies it to outFile
+            doneFile = tmpFile.with_name(f"done_{strSum(str(outFile))}{outExt}")
+        else:
+            doneFile = outFile
+            if pargs.recursive and not outFile.parent.exists():
+                outFile.parent.mkdir(parents=True, exist_ok=True)
+        tmpFile.rename(doneFile)
+
+    # verification and accounting run on the finisher while this slot moves on
+    job = {
+        "cmd": cmd,
+        "timeTaken": timeTaken,
+        "waitTime": waitTime,
+        "encoded": encoded,
+        "crfSearch": crfSearch,
+        "AVCfg": AVCfg,
+        "outFile": outFile,
+        "doneFile": doneFile,
+    }
+    runState.finisher.put((dictToNspace({**vars(plan), **job}),))
+
+    if pargs.wait:
+        waitN(int(pargs.wait), countdown=pargs.jobs == 1)
+        addWait(runState, pargs.wait)
+
+    return file
+
+
+def finishFile(job, runState, addFiles, ffPaths, pargs):
+    file, outFile, doneFile, timer = job.file, job.outFile, job.doneFile, job.timer
+    fmtIn, audioMetaIn, videoMetaIn = job.metas
+
+    with timer.stage("outputMeta"):
+        # without a final out_time or stats report there is nothing to derive from
+        if (
+            pargs.verify
+            or not job.encoded["outTime"]
+            or job.encoded["videoSize"] is None
+        ):
+            fmtOut, videoMetaOut, audioMetaOut = getMeta(
+                ffPaths[0], doneFile, ("video", "audio")
+            )
+        else:
+            fmtOut, videoMetaOut, audioMetaOut = encodedMeta(
+                doneFile, job.encoded, job.AVCfg, audioMetaIn, videoMetaIn
+            )
+        fmtOut = fmtOut._replace(file=str(outFile))
+
+    with timer.stage("compare"):
+        durs = compDur(
+            fmtIn, fmtOut, audioMetaIn, audioMetaOut, videoMetaIn, videoMetaOut
+        )
+        checkDurs(durs)
+
+        bits = compBits(
+            fmtIn, fmtOut, audioMetaIn, audioMetaOut, videoMetaIn, videoMetaOut
+        )
+        checkBits(bits)
+
+    scores = {}
+    if pargs.metrics and videoMetaOut and job.AVCfg[1].codec not in ("vc", "vn"):
+        with timer.stage("metrics"):
+            scores = getScores(ffPaths[1], file, doneFile, fmtIn.duration, pargs)
+
+    result = {
+        "cmd": job.cmd,
+        "timeTaken": job.timeTaken,
+        "waitTime": job.waitTime,
+        "encode": job.encoded,
+        "metrics": scores,
+        "crfSearch": job.crfSearch,
+        "efficient": job.efficient,
+        "copied": job.copied,
+        "stages": timer.toDict(),
+        "input": {
+            "file": str(file),
+            "size": file.stat().st_size,
+            "format": metaDict(fmtIn),
+            "audio": metaDict(audioMetaIn),
+            "video": metaDict(videoMetaIn),
+        },
+        "output": {
+            "file": str(outFile),
+            "size": doneFile.stat().st_size,
+            "format": metaDict(fmtOut),
+            "audio": metaDict(audioMetaOut),
+            "video": metaDict(videoMetaOut),
+        },
+    }
 
-    fmtOut, videoMetaOut, audioMetaOut = getMetaP(outFile, ("video", "audio"))
+    if pargs.scratch:
+        # journaled once the output is safely in place
+        collect = lambda secs: collectResult(
+            {**result, "stages": {**result["stages"], "move": round(secs, 4)}},
+            runState,
+            addFiles,
+            pargs,
+        )
+        runState.mover.put((doneFile, outFile, collect))
+    else:
+        collectResult(result, runState, addFiles, pargs)
 
-    durs = compDur(fmtIn, fmtOut, audioMetaIn, audioMetaOut, videoMetaIn, videoMetaOut)
-    checkDurs(durs)
+    return result
 
-    bits = compBits(fmtIn, fmtOut, audioMetaIn, audioMetaOut, videoMetaIn, videoMetaOut)
-    checkBits(bits)
 
-    results = [
-        *acc,
-        {
-            "cmd": cmd,
-            "timeTaken": timeTaken,
-            "input": {
-                "file": str(file),
-                "size": file.stat().st_size,
-                "format": fmtIn._asdict(),
-                "audio": audioMetaIn._asdict(),
-                "video": videoMetaIn._asdict(),
-            },
-            "output": {
-                "file": str(outFile),
-                "size": outFile.stat().st_size,
-                "format": fmtOut._asdict(),
-                "audio": audioMetaOut._asdict(),
-                "video": videoMetaOut._asdict(),
-            },
-        },
-    ]
-    jsonFile.write_text(dumps(results, indent=2))
+def moveOutput(doneFile, outFile, collect):
+    (_, err), timeTaken = trackTime(isolate, moveVerified, doneFile, outFile)
+    if err:
+        log(f"WARNING: Failed to move {doneFile} to {outFile}, left on scratch: {err}")
+        return
+    collect(timeTaken)
 
-    log(getStats(results, totalFiles))
 
-    if not totalFiles == len(results):
-        if pargs.wait:
-            waitN(int(pargs.wait))
-        else:
-            waitN(int(findPercentOf(8, timeTaken)))
+def orderFiles(fileList, ffprobePath, video, pargs):
+    if pargs.order == "dir":
+        return fileList
+    if pargs.order == "name":
+        return sorted(fileList, key=lambda f: nSort(str(f)))
+    # one concurrent probe pass; it also warms the cache for planFile
+    probed = probeFiles(ffprobePath, fileList, pargs.probeJobs)
+    costs = {f: encodeCost(meta, video) for f, meta in probed}
+    orderKey = lambda f: costs.get(f, 0.0)
+    return sorted(fileList, key=orderKey, reverse=pargs.order == "lpt")
+
+
+slotTmpFile = lambda tmpFile, slot: tmpFile.with_stem(f"{tmpFile.stem}_{slot}")
+
+
+def runPaths(dirPath, pargs):
+    outDir = makeTargetDir(dirPath / f"out_{dirPath.name}")
+    tmpDir = outDir
+    if pargs.scratch:
+        # a per-run subdir, so cleanup never touches the user's scratch dir itself
+        tmpDir = pargs.scratch.resolve() / f"ffu_{strSum(str(dirPath))}"
+        tmpDir.mkdir(parents=True, exist_ok=True)
+    tmpFile = tmpDir / f"tmp_{strSum(dirPath.name)}.tmp"
+    logFile = outDir / f"log_{dirPath.name}.log"
+    jrnlFile = outDir / f"jrnl_{dirPath.name}.jsonl"
+    tmpFiles = [slotTmpFile(tmpFile, s) for s in range1(pargs.jobs)]
+    atexit(cleanUp, (outDir, *tmpFiles, *({tmpDir} - {outDir})))
+    return (outDir, tmpFiles, (tmpFile, logFile, jrnlFile))
+
+
+def loadJournal(jrnlFile):
+    stats, processed = RunStats(), set()
+    for rcd in readJsonl(jrnlFile):
+        processed.add(rcd["input"]["file"])
+        stats = RunStats(rcd["stats"]) if "stats" in rcd else addStats(stats, rcd)
+    return (stats, processed)
+
+
+def newRunState(stats, totalFiles, pargs):
+    return sharedState(
+        stats=stats,
+        totalFiles=totalFiles,
+        active=0,
+        throttle=throttleCfg(pargs.maxLoad, pargs.maxTemp, pargs.minMem),
+        mover=startWorker(moveOutput, pargs.jobs * 2) if pargs.scratch else None,
+        stop=Event(),
+    )
+
 
-    return results
+def runFiles(files, runState, addFiles, AVCfg, ffPaths, pargs, onFail=None):
+    # files may be a lazy, blocking feed of (file, outFile) pairs; with onFail a
+    # failing file is reported to it and skipped instead of stopping the run;
+    # setting runState.stop lets running encodes finish and takes no new files
+    slots = makeSlots(pargs.jobs)
+    planFileP = lambda f: planFile(f, runState, addFiles, AVCfg, ffPaths, pargs)
+    finishFileP = lambda job: finishFile(job, runState, addFiles, ffPaths, pargs)
+    encodeFileP = lambda plan: withSlot(
+        slots, encodeFile, plan, runState, addFiles, ffPaths, pargs
+    )
+    if onFail:
+        planFileP = guard(planFileP, lambda f: f[0], onFail)
+        encodeFileP = guard(encodeFileP, lambda plan: plan.file, onFail)
+        finishFileP = guard(finishFileP, lambda job: job.file, onFail)
+    runState.finisher = startWorker(finishFileP, pargs.jobs, pargs.jobs)
+
+    # plan -> encode -> finish; each stage is bounded so none runs far ahead
+    plans = prefetch(planFileP, files, pargs.prefetch, pargs.probeJobs, runState.stop)
+    try:
+        list(pullMap(encodeFileP, (p for p in plans if p), pargs.jobs, runState.stop))
+    finally:
+        # files already encoded are finished and journaled before any error
+        try:
+            stopWorker(runState.finisher)
+        finally:
+            if runState.mover:
+                stopWorker(runState.mover)
 
 
 def main(pargs):
@@ -315,45 +823,40 @@ def main(pargs):
     )
 
     dirPath = pargs.dir.resolve()
-    fileList = getFileList(dirPath, pargs.extensions, pargs.recursive)
+    fileList = getFileList(
+        dirPath, pargs.extensions, pargs.recursive, pargs.exclude, pargs.followLinks
+    )
     exitIfEmpty(fileList)
     if pargs.only:
         fileList = fileList[: pargs.only]
 
-    outDir = makeTargetDir(dirPath / f"out_{dirPath.name}")
-    tmpFile = outDir / f"tmp_{strSum(dirPath.name)}.tmp"
-    logFile = outDir / f"log_{dirPath.name}.log"
+    outDir, tmpFiles, addFiles = runPaths(dirPath, pargs)
+    _, logFile, jrnlFile = addFiles
     jsonFile = outDir / f"cfg_{dirPath.name}.json"
 
-    if tmpFile in fileList:
-        fileList = [f for f in fileList if not str(f) == str(tmpFile)]
+    fileList = [f for f in fileList if f not in tmpFiles and outDir not in f.parents]
     totalFiles = len(fileList)
 
-    jsonData = loads(jsonFile.read_text()) if jsonFile.exists() else []
-    if jsonData:
-        processed = [x["input"]["file"] for x in jsonData]
+    if jsonFile.exists() and not jrnlFile.exists():
+        jsonToJsonl(jsonFile, jrnlFile)
+
+    stats, processed = loadJournal(jrnlFile)
+    if processed:
         fileList = [f for f in fileList if str(f) not in processed]
 
+    video = videoCfg(pargs.cVideo, pargs.qVideo, pargs.speed, pargs.res, pargs.fps)
+    audio = audioCfg(pargs.cAudio, pargs.qAudio)
+
+    fileList = orderFiles(fileList, ffPaths[0], video, pargs)
     outFiles = [outDir / f.relative_to(dirPath) for f in fileList]
     files = tuple(zip(fileList, outFiles))
 
-    atexit(cleanUp, (outDir, tmpFile))
     setLogFile(logFile)
     log(f"\n\n=== {Path(mainFile).stem} Started at {now()} ===\n")
 
-    video = videoCfg(pargs.cVideo, pargs.qVideo, pargs.speed, pargs.res, pargs.fps)
-    audio = audioCfg(pargs.cAudio, pargs.qAudio)
-
-    mainLoopP = lambda acc, f: mainLoop(
-        acc,
-        f,
-        (tmpFile, logFile, jsonFile),
-        (audio, video),
-        ffPaths,
-        pargs,
-        totalFiles,
-    )
-    results = reduce(mainLoopP, files, jsonData)
+    runState = newRunState(stats, totalFiles, pargs)
+    runFiles(files, runState, addFiles, (audio, video), ffPaths, pargs)
+    log(f"{effLine(runState.stats, pargs.jobs)}\n{cacheSummary()}")
 
 
 if __name__ == "__main__":
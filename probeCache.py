@@ -0,0 +1,55 @@
+from argparse import ArgumentParser
+
+from src.cacheHelpers import cacheEvict, cacheInvalidate, cacheSummary, maxCacheSize
+from src.pkgState import getCacheDir, setCacheDir
+
+
+def cliArgs(parser):
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Files or directories to invalidate; all entries if none given.",
+    )
+    parser.add_argument(
+        "-d",
+        "--cacheDir",
+        default=None,
+        help=f"Cache directory. (default: {getCacheDir()})",
+    )
+    parser.add_argument(
+        "-i",
+        "--invalidate",
+        action="store_true",
+        help="Drop cached metadata for the given paths (or everything).",
+    )
+    parser.add_argument(
+        "-p",
+        "--prune",
+        nargs="?",
+        default=None,
+        const=maxCacheSize // (1024 * 1024),
+        type=int,
+        help="Evict least recently used entries down to N MB. "
+        f"(default: {maxCacheSize // (1024 * 1024)})",
+    )
+    return parser
+
+
+def main(pargs):
+    if pargs.cacheDir:
+        setCacheDir(pargs.cacheDir)
+
+    if pargs.invalidate:
+        print(f"Invalidated {cacheInvalidate(pargs.paths)} entries.")
+
+    if pargs.prune is not None:
+        print(f"Evicted {cacheEvict(pargs.prune * 1024 * 1024)} entries.")
+
+    print(f"\nCache directory: {getCacheDir()}\n{cacheSummary()}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Inspect, invalidate or prune the ffprobe metadata cache."
+    )
+    main(cliArgs(parser).parse_args())
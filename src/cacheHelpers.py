@@ -0,0 +1,152 @@
+import sqlite3
+from json import dumps, loads
+from os import environ, sep
+from pathlib import Path
+from threading import Lock, local
+from time import time
+
+from .helpers import readableSize
+from .pkgState import getCacheDir
+
+maxCacheSize = int(environ.get("FFU_CACHE_MAX_MB", 512)) * 1024 * 1024
+
+evictEvery = 1000
+
+cacheCounts = {"hits": 0, "misses": 0, "puts": 0}
+
+countLock = Lock()
+
+dbLocal = local()
+
+cacheSchema = """
+CREATE TABLE IF NOT EXISTS probe (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    inode INTEGER,
+    data TEXT,
+    used REAL
+)
+"""
+
+
+def countCache(key):
+    with countLock:
+        cacheCounts[key] += 1
+        return cacheCounts[key]
+
+
+def getCacheDb():
+    cacheDir = getCacheDir()
+    if cacheDir is None:
+        return None
+    dbFile = cacheDir / "probe.sqlite"
+    if getattr(dbLocal, "file", None) != dbFile:
+        cacheDir.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(dbFile, timeout=60)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(cacheSchema)
+        dbLocal.db, dbLocal.file = db, dbFile
+    return dbLocal.db
+
+
+def dbPath(path):
+    # undecodable names arrive as surrogates, which sqlite text cannot hold
+    return (
+        str(path).encode("utf8", "surrogateescape").decode("utf8", "backslashreplace")
+    )
+
+
+def fileKey(file):
+    try:
+        path = Path(file).resolve()
+        st = path.stat()
+    except OSError:
+        return None
+    return (dbPath(path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def cacheGet(file):
+    db, key = getCacheDb(), fileKey(file)
+    if db is None or key is None:
+        return None
+    row = db.execute(
+        "SELECT data FROM probe WHERE path=? AND size=? AND mtime=? AND inode=?",
+        key,
+    ).fetchone()
+    if row is None:
+        countCache("misses")
+        return None
+    countCache("hits")
+    with db:
+        db.execute("UPDATE probe SET used=? WHERE path=?", (time(), key[0]))
+    return loads(row[0])
+
+
+def cachePut(file, data):
+    db, key = getCacheDb(), fileKey(file)
+    if db is None or key is None or not isinstance(data, dict):
+        return data
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?, ?)",
+            (*key, dumps(data), time()),
+        )
+    if countCache("puts") % evictEvery == 0:
+        cacheEvict()
+    return data
+
+
+def cacheEvict(maxSize=None):
+    db = getCacheDb()
+    if db is None:
+        return 0
+    maxSize = maxCacheSize if maxSize is None else maxSize
+    total = db.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM probe").fetchone()[0]
+    if total <= maxSize:
+        return 0
+    excess = total - int(maxSize * 0.9)  # leave some headroom
+    rows = db.execute("SELECT path, LENGTH(data) FROM probe ORDER BY used")
+    stale = []
+    for path, size in rows:
+        if excess <= 0:
+            break
+        stale.append((path,))
+        excess -= size
+    with db:
+        return db.executemany("DELETE FROM probe WHERE path=?", stale).rowcount
+
+
+def cacheInvalidate(paths=None):
+    db = getCacheDb()
+    if db is None:
+        return 0
+    with db:
+        if not paths:
+            return db.execute("DELETE FROM probe").rowcount
+        return sum(
+            db.execute(
+                "DELETE FROM probe WHERE path=? OR substr(path, 1, ?)=?",
+                (dbPath(p), len(f"{dbPath(p)}{sep}"), f"{dbPath(p)}{sep}"),
+            ).rowcount
+            for p in (Path(p).resolve() for p in paths)
+        )
+
+
+def cacheInfo():
+    db = getCacheDb()
+    if db is None:
+        return {"entries": 0, "size": 0, **cacheCounts}
+    entries, size = db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM probe"
+    ).fetchone()
+    return {"entries": entries, "size": size, **cacheCounts}
+
+
+def cacheSummary():
+    info = cacheInfo()
+    return (
+        f"Probe cache:: Hits: {info['hits']}, Misses: {info['misses']}"
+        f", Entries: {info['entries']} & Size: {readableSize(info['size'])}."
+    )
@@ -0,0 +1,107 @@
+from json import dumps
+from threading import Lock
+
+from .ffHelpers import (
+    ffmpegJoinCmd,
+    ffmpegSegmentCmd,
+    getffmpegCmd,
+    optsVideo,
+    selectCodec,
+)
+from .helpers import range1, round2, strSum
+from .jobHelpers import poolMap
+from .osHelpers import appendJsonl, readJsonl, removeFile, rmEmptyDir, runCmdProgress
+
+jrnlLock = Lock()
+
+chunkTimes = lambda duration, chunks: [
+    round2(float(duration) / chunks * i) for i in range1(chunks - 1)
+]
+
+
+def splitChunks(ffmpegPath, file, workDir, duration, chunks):
+    # segment muxer cuts at the first keyframe after each time
+    for seg in workDir.glob("src_*.mkv"):
+        removeFile(seg)
+    cmd = ffmpegSegmentCmd(
+        ffmpegPath, file, chunkTimes(duration, chunks), workDir / "src_%03d.mkv"
+    )
+    runCmdProgress(cmd, duration, f"{file.name} [split]")
+    return sorted(workDir.glob("src_*.mkv"))
+
+
+def chunkOpts(AVCfg, audioMeta, videoMeta):
+    audio, video = AVCfg
+    ov = optsVideo(videoMeta.height, videoMeta.fps, video.res, video.fps)
+    cv = selectCodec(video.codec, video.quality, video.speed)
+    ca = audioMeta and ["-map", "0:a:0", *selectCodec(audio.codec, audio.quality)]
+    return ([*cv, *ov, "-an"], ca)
+
+
+def chunkDir(tmpDir, file, AVCfg, audioMeta, videoMeta):
+    # keyed on the encode opts too, so chunks from other settings are never reused
+    fileKey = strSum(str(file))
+    optsKey = strSum(dumps(chunkOpts(AVCfg, audioMeta, videoMeta)))
+    workDir = tmpDir / f"chunks_{fileKey}_{optsKey}"
+    for staleDir in tmpDir.glob(f"chunks_{fileKey}_*"):
+        if staleDir != workDir:
+            for f in staleDir.iterdir():
+                removeFile(f)
+            rmEmptyDir(staleDir)
+    return workDir
+
+
+def chunkTasks(file, workDir, AVCfg, audioMeta, videoMeta):
+    vOpts, aOpts = chunkOpts(AVCfg, audioMeta, videoMeta)
+    tasks = [
+        (src.name, src, workDir / src.name.replace("src_", "enc_"), vOpts)
+        for src in sorted(workDir.glob("src_*.mkv"))
+    ]
+    if aOpts:
+        tasks.append(("audio", file, workDir / "audio.mka", aOpts))
+    return tasks
+
+
+def encodeTask(ffmpegPath, jrnlFile, task, label):
+    name, src, encFile, opts = task
+    partFile = encFile.with_name(f"part_{encFile.name}")
+    removeFile(partFile)
+    progress = runCmdProgress(
+        getffmpegCmd(ffmpegPath, src, partFile, opts), label=f"{label} [{name}]"
+    )
+    partFile.rename(encFile)
+    with jrnlLock:
+        appendJsonl(jrnlFile, {"chunk": name, **progress})
+    return encFile
+
+
+def encodeChunked(ffmpegPath, file, outFile, workDir, AVCfg, metas, chunks, jobs):
+    fmtMeta, audioMeta, videoMeta = metas
+    workDir.mkdir(parents=True, exist_ok=True)
+    jrnlFile = workDir / "chunks.jsonl"
+    done = {rcd["chunk"] for rcd in readJsonl(jrnlFile)}
+
+    if "split" not in done:
+        splitChunks(ffmpegPath, file, workDir, fmtMeta.duration, chunks)
+        appendJsonl(jrnlFile, {"chunk": "split"})
+
+    tasks = chunkTasks(file, workDir, AVCfg, audioMeta, videoMeta)
+    pending = [t for t in tasks if t[0] not in done or not t[2].exists()]
+    encodeTaskP = lambda t: encodeTask(ffmpegPath, jrnlFile, t, file.name)
+    list(poolMap(encodeTaskP, pending, jobs))
+
+    videoFiles = [t[2] for t in tasks if t[0] != "audio"]
+    audioFile = workDir / "audio.mka" if audioMeta else None
+    listFile = workDir / "chunks.txt"
+    listFile.write_text("".join(f"file '{f.name}'\n" for f in videoFiles))
+
+    progress = runCmdProgress(
+        ffmpegJoinCmd(ffmpegPath, listFile, audioFile, outFile),
+        fmtMeta.duration,
+        f"{file.name} [join]",
+    )
+
+    for f in workDir.iterdir():
+        removeFile(f)
+    rmEmptyDir(workDir)
+    return progress
@@ -2,6 +2,7 @@ from argparse import ArgumentTypeError
 from pathlib import Path
 
 from .helpers import csvToList, prefixDots
+from .jobHelpers import checkJobs, defaultJobs
 
 
 def checkDirPath(pth):
@@ -32,6 +33,20 @@ def addCliRec(parser):
         action="store_true",
         help="Process files recursively in all child directories.",
     )
+    parser.add_argument(
+        "-xd",
+        "--exclude",
+        default=["out_*", "tests_*"],
+        type=csvToList,
+        help="Comma separated name globs of directories not to descend into; "
+        "pass an empty string to skip none. (default: out_*, tests_*)",
+    )
+    parser.add_argument(
+        "-fl",
+        "--followLinks",
+        action="store_true",
+        help="Follow symbolic links to directories when recursing.",
+    )
     return parser
 
 
@@ -75,6 +90,100 @@ def addCliWait(parser, dft=10):
         default=None,
         const=dft,
         type=int,
-        help=f"Wait time in seconds between each iteration, default is {dft}",
+        help=f"Fixed wait time in seconds between each iteration instead of "
+        f"load-aware throttling, default is {dft}",
+    )
+    return parser
+
+
+def addCliJobs(parser, dft=None):
+    dft = dft or defaultJobs()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=dft,
+        type=checkJobs,
+        help=f"Number of files to process in parallel, 0 for auto. (default: {dft})",
+    )
+    return parser
+
+
+def addCliProbeJobs(parser, dft=None):
+    dft = dft or min(32, defaultJobs(1) * 4)
+    parser.add_argument(
+        "-pj",
+        "--probeJobs",
+        default=dft,
+        type=checkJobs,
+        help=f"Number of concurrent ffprobe processes. (default: {dft})",
+    )
+    return parser
+
+
+def addCliThrottle(parser):
+    parser.add_argument(
+        "-ml",
+        "--maxLoad",
+        default=1.0,
+        type=float,
+        help="Delay new jobs while the 1 minute load average per core is above "
+        "this and the cpu is still busy. (default: 1.0)",
+    )
+    parser.add_argument(
+        "-mt",
+        "--maxTemp",
+        default=85,
+        type=int,
+        help="Delay new jobs while cpu temperature in Celsius is above this; "
+        "needs /sys/class/thermal. (default: 85)",
+    )
+    parser.add_argument(
+        "-mm",
+        "--minMem",
+        default=512,
+        type=int,
+        help="Delay new jobs while available memory in MB is below this. "
+        "(default: 512)",
+    )
+    return parser
+
+
+def addCliMetrics(parser):
+    metrics = ["vmaf", "ssim", "psnr"]
+    parser.add_argument(
+        "-mx",
+        "--metrics",
+        default=[],
+        type=lambda vals: [checkValIn(v, metrics, str) for v in csvToList(vals)],
+        help="Comma separated quality metrics to score the output against the "
+        f"source with, from {', '.join(metrics)}; needs ffmpeg built with libvmaf."
+        " (default: none)",
+    )
+    parser.add_argument(
+        "-ms",
+        "--subsample",
+        default=5,
+        type=int,
+        help="Score only every Nth frame when computing metrics. (default: 5)",
+    )
+    dft = defaultJobs()
+    parser.add_argument(
+        "-mth",
+        "--metricThreads",
+        default=dft,
+        type=checkJobs,
+        help=f"Threads used per metrics run, 0 for auto. (default: {dft})",
+    )
+    return parser
+
+
+def addCliProm(parser):
+    parser.add_argument(
+        "-pm",
+        "--prom",
+        default=None,
+        type=Path,
+        help="Write per-stage timings and file counts to this Prometheus "
+        "textfile-collector file (*.prom), replaced atomically on each update.",
     )
     return parser
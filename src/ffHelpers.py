@@ -1,14 +1,26 @@
+from asyncio import FIRST_COMPLETED, create_task, gather, new_event_loop, wait
+from collections import namedtuple
 from fractions import Fraction
+from json import loads
+from queue import Queue
+from threading import Thread
 
+from .cacheHelpers import cacheGet, cachePut
 from .helpers import (
     dictToNspace,
-    dictToNTuple,
     extractKeysDict,
+    range1,
     readableSize,
     readableTime,
     round2,
 )
-from .osHelpers import runCmdJson
+from .osHelpers import (
+    removeFile,
+    runCmd,
+    runCmdJson,
+    runCmdJsonAsync,
+    runCmdProgress,
+)
 
 
 def audioCfg(codec, quality=None, speed=None):
@@ -19,39 +31,43 @@ def videoCfg(codec, quality=None, speed=None, res=None, fps=None):
     return dictToNspace(locals())
 
 
+fmtKeys = ("filename", "size", "format_name", "nb_streams", "duration", "bit_rate")
+
+strmKeys = ("codec_type", "codec_name", "profile", "duration", "bit_rate")
+
+audioKeys = (*strmKeys, "channels", "sample_rate")
+
+videoKeys = (*strmKeys, "width", "height", "r_frame_rate", "pix_fmt")
+# "color_range" "color_primaries"
+
+strmFields = ("type", "codec", "profile", "duration", "bits")
+
+FormatMeta = namedtuple(
+    "FormatMeta", ("file", "size", "format", "streams", "duration", "bits")
+)
+
+StreamMeta = namedtuple("StreamMeta", strmFields)
+
+AudioMeta = namedtuple("AudioMeta", (*strmFields, "channels", "samples"))
+
+VideoMeta = namedtuple("VideoMeta", (*strmFields, "width", "height", "fps", "pixFmt"))
+
+strmTypes = {
+    "audio": (AudioMeta, audioKeys),
+    "video": (VideoMeta, videoKeys),
+}
+
+
 def fmtMeta(metaData):
-    m = metaData["format"].get
-    data = {
-        "file": m("filename"),
-        "size": m("size"),
-        "format": m("format_name"),
-        "streams": m("nb_streams"),
-        "duration": m("duration"),
-        "bits": m("bit_rate"),
-    }
-    return dictToNTuple("FormatMeta", data)
+    return FormatMeta._make(map(metaData["format"].get, fmtKeys))
 
 
 def streamMeta(metaData, strm):
+    if strm is None:
+        return None
     m = metaData["streams"][strm].get
-    data = {
-        "type": m("codec_type"),
-        "codec": m("codec_name"),
-        "profile": m("profile"),
-        "duration": m("duration"),
-        "bits": m("bit_rate"),
-    }
-    if data["type"] == "audio":
-        data = {**data, "channels": m("channels"), "samples": m("sample_rate")}
-    elif data["type"] == "video":
-        data = {
-            **data,
-            "height": m("height"),
-            "fps": m("r_frame_rate"),
-            "pixFmt": m("pix_fmt"),
-        }  # "color_range" "color_primaries"
-
-    return dictToNTuple("StreamMeta", data)
+    recType, keys = strmTypes.get(m("codec_type"), (StreamMeta, strmKeys))
+    return recType._make(map(m, keys))
 
 
 getffprobeCmd = lambda ffprobePath, file: [
@@ -85,6 +101,44 @@ ffmpegTrimCmd = lambda ffmpegPath, file, outFile, start, length: [
     str(outFile),
 ]
 
+ffprobeKeyframesCmd = lambda ffprobePath, file, starts: [
+    ffprobePath,
+    "-v",
+    "quiet",
+    "-select_streams",
+    "v:0",
+    "-skip_frame",
+    "nokey",
+    "-show_entries",
+    "frame=pts_time",
+    "-of",
+    "csv=p=0",
+    "-read_intervals",
+    ",".join(f"{s}%+#1" for s in starts),
+    str(file),
+]
+
+ffmpegSamplesCmd = lambda ffmpegPath, outFile: [
+    ffmpegPath,
+    "-f",
+    "concat",
+    "-safe",
+    "0",
+    "-protocol_whitelist",
+    "file,pipe",
+    "-i",
+    "pipe:0",
+    "-map_metadata",
+    "-1",
+    "-c",
+    "copy",
+    "-avoid_negative_ts",
+    "1",
+    "-loglevel",
+    "24",
+    str(outFile),
+]
+
 ffmpegConcatCmd = lambda ffmpegPath, splitsFile, outFile: [
     ffmpegPath,
     "-f",
@@ -101,21 +155,214 @@ ffmpegConcatCmd = lambda ffmpegPath, splitsFile, outFile: [
     str(outFile),
 ]
 
+ffmpegSegmentCmd = lambda ffmpegPath, file, times, segPattern: [
+    ffmpegPath,
+    "-i",
+    str(file),
+    "-map",
+    "0:v:0",
+    "-c",
+    "copy",
+    "-f",
+    "segment",
+    "-segment_times",
+    ",".join(str(t) for t in times),
+    "-reset_timestamps",
+    "1",
+    "-loglevel",
+    "24",
+    "-nostdin",
+    str(segPattern),
+]
+
+ffmpegJoinCmd = lambda ffmpegPath, listFile, audioFile, outFile: [
+    ffmpegPath,
+    "-f",
+    "concat",
+    "-safe",
+    "0",
+    "-i",
+    str(listFile),
+    *(["-i", str(audioFile), "-map", "0:v", "-map", "1:a"] if audioFile else []),
+    "-c",
+    "copy",
+    "-loglevel",
+    "32",
+    "-nostdin",
+    str(outFile),
+]
+
+metricNames = ("vmaf", "ssim", "psnr")
+
+metricFeatures = {"ssim": "float_ssim", "psnr": "psnr"}
+
+metricKeys = {"vmaf": "vmaf", "ssim": "float_ssim", "psnr": "psnr_y"}
+
+# escaped for both the filtergraph and the filter option parser
+filterPath = lambda pth: str(pth).replace("\\", "/").replace(":", r"\\:")
+
+
+def vmafOpts(metrics, logFile, threads, subsample):
+    # built-in model, no model file needed; ssim/psnr come from the same pass
+    feats = "|".join(
+        f"name={metricFeatures[m]}" for m in metrics if m in metricFeatures
+    )
+    return ":".join(
+        [
+            "model=version=vmaf_v0.6.1",
+            *([f"feature={feats}"] if feats else []),
+            f"n_threads={threads}",
+            f"n_subsample={subsample}",
+            "log_fmt=json",
+            f"log_path={filterPath(logFile)}",
+        ]
+    )
+
+
+ffmpegMetricsCmd = lambda ffmpegPath, refFile, distFile, vmaf: [
+    ffmpegPath,
+    "-i",
+    str(distFile),
+    "-i",
+    str(refFile),
+    "-lavfi",
+    "[0:v][1:v]scale2ref=flags=bicubic[dist][ref];"
+    "[dist]setpts=PTS-STARTPTS[d];[ref]setpts=PTS-STARTPTS[r];"
+    f"[d][r]libvmaf={vmaf}",
+    "-loglevel",
+    "24",
+    "-nostdin",
+    "-f",
+    "null",
+    "-",
+]
+
 getffmpegCmd = lambda ffmpegPath, file, outFile, opts=[]: [
     ffmpegPath,
     "-i",
     str(file),
     *opts,
     "-loglevel",
-    "24",
+    "32",
     "-nostdin",
     str(outFile),
 ]
 
 
-def getMetaData(ffprobePath, file):
+def getMetaData(ffprobePath, file, cache=True):
+    metaData = cache and cacheGet(file)
+    if metaData:
+        return metaData
     ffprobeCmd = getffprobeCmd(ffprobePath, file)
-    return runCmdJson(ffprobeCmd)
+    metaData = runCmdJson(ffprobeCmd)
+    return cachePut(file, metaData) if cache else metaData
+
+
+async def probeFile(ffprobePath, file, cache=True):
+    try:
+        metaData = cache and cacheGet(file)
+        if not metaData:
+            metaData = await runCmdJsonAsync(getffprobeCmd(ffprobePath, file))
+            if cache:
+                cachePut(file, metaData)
+    except Exception as probeErr:
+        return (file, probeErr)
+    return (file, metaData)
+
+
+async def probeFilesAsync(ffprobePath, files, jobs, cache=True):
+    files, pending = iter(files), set()
+    try:
+        while True:
+            for file in files:
+                pending.add(create_task(probeFile(ffprobePath, file, cache)))
+                if len(pending) >= jobs:
+                    break
+            if not pending:
+                return
+            done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await gather(*pending, return_exceptions=True)
+
+
+def probeFiles(ffprobePath, files, jobs, cache=True):
+    # (file, metaData | Exception) pairs in completion order; a failure of the
+    # feed itself (e.g. the file listing) is raised in the consumer
+    results, end = Queue(maxsize=jobs * 2), object()
+
+    async def feed():
+        async for res in probeFilesAsync(ffprobePath, files, jobs, cache):
+            results.put(res)
+
+    def runLoop():
+        loop = new_event_loop()
+        try:
+            loop.run_until_complete(feed())
+            results.put(end)
+        except BaseException as feedErr:
+            results.put(feedErr)
+        finally:
+            loop.close()
+
+    def consume():
+        for res in iter(results.get, end):
+            if isinstance(res, BaseException):
+                raise res
+            yield res
+
+    Thread(target=runLoop, daemon=True).start()
+    return consume()
+
+
+metaDict = lambda meta: meta and meta._asdict()
+
+
+def getKeyframes(ffprobePath, file, starts, ext=True):
+    # keyframe at or before each start; seeks instead of decoding the file
+    cmdOut = runCmd(ffprobeKeyframesCmd(ffprobePath, file, starts), ext)
+    kfs = [float(t) for t in cmdOut.replace(",", " ").split() if t != "N/A"]
+    return kfs if len(kfs) == len(starts) else list(starts)
+
+
+def calcSplits(secs, splits, length):
+    s = float(secs) / splits
+    return [(s * i - length * i) for i in range1(splits)]
+
+
+def samplesList(file, starts, length):
+    fileUrl = "file:" + str(file).replace("'", "'\\''")
+    return "ffconcat version 1.0\n" + "".join(
+        f"file '{fileUrl}'\ninpoint {s}\noutpoint {s + length}\n" for s in starts
+    )
+
+
+def getMetrics(ffmpegPath, refFile, distFile, cfg, duration=None, ext=True):
+    # cfg: metrics, metricThreads & subsample, as parsed by addCliMetrics
+    logFile = distFile.with_name(f"vmaf_{distFile.stem}.json")
+    vmaf = vmafOpts(cfg.metrics, logFile, cfg.metricThreads, cfg.subsample)
+    try:
+        runCmdProgress(
+            ffmpegMetricsCmd(ffmpegPath, refFile, distFile, vmaf),
+            duration,
+            f"{distFile.name} [metrics]",
+            ext=ext,
+        )
+        pooled = loads(logFile.read_text())["pooled_metrics"]
+    finally:
+        removeFile(logFile)
+    return {m: round(pooled[metricKeys[m]]["mean"], 4) for m in cfg.metrics}
+
+
+def readableScores(stats):
+    return {
+        m.upper(): f"{round(stats[m].mean, 4)} (min: {round(stats[m].low, 4)})"
+        for m in metricNames
+        if stats[m].count
+    }
 
 
 def findStream(meta, sType):
@@ -158,7 +405,9 @@ def getTagKeys(meta, keys, asDict=False):
 
 
 def readableMeta(meta):
-    if isinstance(meta, tuple) and hasattr(meta, "_asdict"):
+    if meta is None:
+        return {}
+    elif isinstance(meta, tuple) and hasattr(meta, "_asdict"):
         data = meta._asdict()
     elif isinstance(meta, dict):
         data = {**meta}  # Don't mutate source
@@ -178,6 +427,46 @@ def readableMeta(meta):
     return data
 
 
+audioBitsDefault = {"aac": 72, "he": 56, "opus": 48}
+
+crfRanges = {"avc": (17, 35), "hevc": (20, 38), "av1": (20, 63)}
+
+bppLimits = {"avc": 0.08, "hevc": 0.05, "av1": 0.04}
+
+copyCodecs = ("h264", "hevc", "av1", "vp9")
+
+copyFormats = {"opus": ".opus", "aac": ".m4a"}
+
+codecCosts = {"avc": 1.0, "hevc": 2.5, "av1": 2.0, "vc": 0.02, "vn": 0.01}
+
+presetCosts = {
+    "ultrafast": 0.15,
+    "superfast": 0.25,
+    "veryfast": 0.4,
+    "faster": 0.6,
+    "fast": 0.8,
+    "medium": 1.0,
+    "slow": 1.6,
+    "slower": 3.0,
+    "veryslow": 6.0,
+}
+
+codecNames = {
+    "aac": ("aac", "LC"),
+    "he": ("aac", "HE-AAC"),
+    "opus": ("opus", None),
+    "avc": ("h264", "High"),
+    "hevc": ("hevc", "Main"),
+    "av1": ("av1", "Main"),
+}
+
+formatNames = {
+    ".mp4": "mov,mp4,m4a,3gp,3g2,mj2",
+    ".m4a": "mov,mp4,m4a,3gp,3g2,mj2",
+    ".opus": "ogg",
+}
+
+
 def selectCodec(codec, quality=None, speed=None):
 
     quality = quality and str(quality)
@@ -196,7 +485,7 @@ def selectCodec(codec, quality=None, speed=None):
             "-c:a",
             "libfdk_aac",
             "-b:a",
-            f'{quality or "72"}k',
+            f'{quality or audioBitsDefault["aac"]}k',
             "-afterburner",
             "1",
             "-cutoff",
@@ -214,7 +503,7 @@ def selectCodec(codec, quality=None, speed=None):
             "-profile:a",
             "aac_he",
             "-b:a",
-            f'{quality or "56"}k',
+            f'{quality or audioBitsDefault["he"]}k',
             "-afterburner",
             "1",
         ]
@@ -226,7 +515,7 @@ def selectCodec(codec, quality=None, speed=None):
             "-c:a",
             "libopus",
             "-b:a",
-            f'{quality or "48"}k',
+            f'{quality or audioBitsDefault["opus"]}k',
             "-vbr",
             "on",
             "-compression_level",
@@ -279,7 +568,7 @@ def selectFormat(codec=None):
         return ".m4a"
     elif codec in ("opus"):
         return ".opus"
-    elif codec in ("hevc", "avc", "av1"):
+    elif codec in ("hevc", "avc", "av1", "vc"):
         return ".mp4"
 
 
@@ -303,24 +592,180 @@ def optsVideo(srcRes, srcFps, limitRes, limitFps):
     return opts
 
 
+def videoBpp(fmtMeta, videoMeta):
+    # stream bit rate is missing in some containers; format rate overestimates
+    bits = videoMeta.bits or fmtMeta.bits
+    try:
+        pixels = int(videoMeta.width) * int(videoMeta.height)
+        return float(bits) / (pixels * float(Fraction(videoMeta.fps)))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def efficientBpp(video, fmtMeta, videoMeta, maxBpp=None):
+    # bpp of sources that re-encoding would not meaningfully shrink, else None
+    if video.codec not in bppLimits or videoMeta is None:
+        return None
+    if videoMeta.codec not in copyCodecs:
+        return None
+    ov = optsVideo(videoMeta.height, videoMeta.fps, video.res, video.fps)
+    if "-vf" in ov or "-r" in ov:
+        return None
+    bpp = videoBpp(fmtMeta, videoMeta)
+    limit = maxBpp or bppLimits[video.codec]
+    return bpp if bpp is not None and bpp <= limit else None
+
+
+def audioMatches(audio, audioMeta, fmtBits=None):
+    if audio.codec not in codecNames or audioMeta is None:
+        return False
+    codec, profile = codecNames[audio.codec]
+    limit = int(audio.quality or audioBitsDefault[audio.codec]) * 1000
+    try:
+        bits = float(audioMeta.bits or fmtBits)
+    except (TypeError, ValueError):
+        return False
+    return (
+        audioMeta.codec == codec
+        and (profile is None or (audioMeta.profile or "").startswith(profile))
+        and bits <= limit * 1.05  # encoders overshoot the nominal rate slightly
+    )
+
+
+def videoMatches(video, fmtMeta, videoMeta, maxBpp=None):
+    if video.codec not in codecNames or videoMeta is None:
+        return False
+    return (
+        videoMeta.codec == codecNames[video.codec][0]
+        and videoMeta.pixFmt == "yuv420p"
+        and efficientBpp(video, fmtMeta, videoMeta, maxBpp) is not None
+    )
+
+
+def autoCopy(AVCfg, fmtMeta, audioMeta, videoMeta, maxBpp=None):
+    # copy streams that already match their target instead of re-encoding them
+    audio, video = AVCfg
+    copied = []
+    # audio only containers like ogg only carry the overall bit rate
+    if audioMatches(audio, audioMeta, None if videoMeta else fmtMeta.bits):
+        audio = audioCfg("ac")
+        copied.append("audio")
+    if videoMatches(video, fmtMeta, videoMeta, maxBpp):
+        video = videoCfg("vc", None, None, video.res, video.fps)
+        copied.append("video")
+    return (audio, video, copied)
+
+
+def speedCost(video):
+    if video.codec == "av1":
+        return 2 ** ((8 - int(video.speed or 8)) / 2)  # svt-av1 presets, 8 = 1
+    dft = {"avc": "slow", "hevc": "medium"}.get(video.codec, "medium")
+    return presetCosts.get(video.speed or dft, 1.0)
+
+
+def encodeCost(metaData, video):
+    # relative encode effort: seconds x output pixels x output fps x codec/preset
+    if isinstance(metaData, Exception):
+        return 0.0
+    fmtData = fmtMeta(metaData)
+    videoMeta = streamMeta(metaData, findStream(metaData, "video"))
+    duration = float(fmtData.duration or 0)
+    if videoMeta is None or video.codec == "vn":
+        return duration * 1e3  # audio only, cheap next to any video
+    try:
+        width, height = int(videoMeta.width), int(videoMeta.height)
+        fps = float(Fraction(videoMeta.fps))
+    except (TypeError, ValueError, ZeroDivisionError):
+        width, height, fps = 1280, 720, 30.0
+    if video.res and height > video.res:
+        width, height = width * video.res / height, video.res
+    if video.fps:
+        fps = min(fps, video.fps)
+    cost = duration * width * height * fps * codecCosts.get(video.codec, 1.0)
+    return cost * (speedCost(video) if video.codec in crfRanges else 1.0)
+
+
 def ffCmdOpts(audio=None, video=None, audioMeta=None, videoMeta=None):
     if videoMeta:
-        ov = optsVideo(videoMeta.height, videoMeta.fps, video.res, video.fps)
+        ov = (
+            []
+            if video.codec in ("vc", "vn")
+            else optsVideo(videoMeta.height, videoMeta.fps, video.res, video.fps)
+        )
         cv = selectCodec(video.codec, video.quality, video.speed)
         outExt = selectFormat(video.codec)
     else:
         ov, cv = [], []
-        outExt = selectFormat(audio.codec)
+        outExt = selectFormat(audio.codec) or copyFormats.get(audioMeta.codec, ".m4a")
 
     ca = selectCodec(audio.codec, audio.quality) if audioMeta else []
 
     return ([*ca, *cv, *ov], outExt)
 
 
+def encodedAudioMeta(audio, audioMeta, duration, bits):
+    if audio.codec == "ac":
+        return audioMeta._replace(duration=duration)
+    codec, profile = codecNames[audio.codec]
+    samples = {"aac": "32000", "opus": "48000"}.get(audio.codec, audioMeta.samples)
+    return AudioMeta(
+        "audio",
+        codec,
+        profile,
+        duration,
+        bits,
+        audioMeta.channels,
+        samples,
+    )
+
+
+def encodedVideoMeta(video, videoMeta, duration, bits):
+    if video.codec == "vn":
+        return None
+    elif video.codec == "vc":
+        return videoMeta._replace(duration=duration)
+    codec, profile = codecNames[video.codec]
+    width, height, fps = videoMeta.width, videoMeta.height, videoMeta.fps
+    if video.res and int(height) > video.res:
+        # scale=-2:res keeps the aspect ratio with an even width
+        width = round(int(width) * video.res / int(height) / 2) * 2
+        height = video.res
+    if video.fps and float(Fraction(fps)) > video.fps:
+        fps = f"{video.fps}/1"
+    return VideoMeta(
+        "video", codec, profile, duration, bits, width, height, fps, "yuv420p"
+    )
+
+
+def encodedMeta(outFile, progress, AVCfg, audioMeta=None, videoMeta=None):
+    # output metadata from ffmpeg's final progress and stats reports and the
+    # encode settings; stream bitrates come from the muxed stream sizes
+    audio, video = AVCfg
+    size = outFile.stat().st_size
+    secs = progress["outTime"]
+    duration = f"{secs:.6f}" if secs else None
+    bitRate = lambda n: str(int(n * 8 / secs)) if secs and n is not None else None
+
+    audioBits = bitRate(progress["audioSize"])
+    audioOut = audioMeta and encodedAudioMeta(audio, audioMeta, duration, audioBits)
+    videoBits = bitRate(progress["videoSize"])
+    videoOut = videoMeta and encodedVideoMeta(video, videoMeta, duration, videoBits)
+
+    fmtOut = FormatMeta(
+        str(outFile),
+        str(size),
+        formatNames.get(outFile.suffix),
+        sum(1 for m in (audioOut, videoOut) if m),
+        duration,
+        bitRate(size),
+    )
+    return (fmtOut, videoOut, audioOut)
+
+
 def absFloatDiff(src, out, n=1):
     try:
         diff = abs(float(src) - float(out))
-    except ValueError:
+    except (TypeError, ValueError):
         return None
     return diff if diff > n else False
 
@@ -331,7 +776,7 @@ def negFloatDiff(src, out):
             return float(out) - float(src)
         else:
             return False
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
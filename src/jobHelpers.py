@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import cpu_count
+from queue import Queue
+from threading import Event, Lock, Thread
+
+from .helpers import dictToNspace, range1
+
+defaultJobs = lambda div=4: max(1, (cpu_count() or 1) // div)
+
+
+def checkJobs(val):
+    jobs = int(val)
+    return jobs if jobs > 0 else defaultJobs()
+
+
+def makeSlots(n):
+    slots = Queue()
+    for s in range1(n):
+        slots.put(s)
+    return slots
+
+
+def withSlot(slots, func, *funcArgs):
+    slot = slots.get()
+    try:
+        return func(slot, *funcArgs)
+    finally:
+        slots.put(slot)
+
+
+def poolMap(func, itr, jobs):
+    # yields results as they finish; pending jobs are dropped on first error
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    futures = [pool.submit(func, i) for i in itr]
+    try:
+        for ftr in as_completed(futures):
+            yield ftr.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def isolate(func, *funcArgs):
+    # errors are expected to be reported by func; only the outcome is kept
+    try:
+        return (func(*funcArgs), None)
+    except Exception as funcErr:
+        return (None, funcErr)
+
+
+def guard(func, key, onFail):
+    # per item isolation; also catches the exit of reportErr, which has already
+    # logged the error, so one failing item cannot end a long running pool
+    def run(item):
+        try:
+            return func(item)
+        except (Exception, SystemExit) as itemErr:
+            onFail(key(item), itemErr)
+            return None
+
+    return run
+
+
+def sharedState(**kwargs):
+    return dictToNspace({**kwargs, "lock": Lock()})
+
+
+def pullMap(func, itr, jobs, stop=None):
+    # workers take the next item only once free, so a lazy itr is never drained
+    # ahead of them; pending items are dropped on first error or once stop is set
+    itr, itrLock, stop = iter(itr), Lock(), stop or Event()
+
+    def take():
+        with itrLock:
+            item = None if stop.is_set() else next(itr, None)
+        return None if stop.is_set() else item
+
+    def work():
+        try:
+            return [func(item) for item in iter(take, None)]
+        except BaseException:
+            stop.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(work) for _ in range1(jobs)]
+        for ftr in as_completed(futures):
+            yield from ftr.result()
+
+
+def prefetch(func, itr, ahead, jobs=1, stop=None):
+    # func runs on up to jobs threads at most ahead items in front of the
+    # consumer; results keep the order of itr, which may block between items;
+    # once stop is set no further item is submitted
+    pool, pending, end = ThreadPoolExecutor(max_workers=jobs), Queue(ahead), object()
+    stop = stop or Event()
+
+    def feed():
+        try:
+            for item in itr:
+                if stop.is_set():
+                    break
+                pending.put(pool.submit(func, item))
+        finally:
+            pending.put(end)
+
+    Thread(target=feed, daemon=True).start()
+    try:
+        for ftr in iter(pending.get, end):
+            yield ftr.result()
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def startWorker(func, maxPending=4, workers=1):
+    # background consumers; put() blocks while maxPending tasks are waiting
+    tasks, errors = Queue(maxsize=maxPending), []
+
+    def run():
+        for task in iter(tasks.get, None):
+            try:
+                func(*task)
+            except BaseException as err:
+                # kept consuming so producers never block; raised on stop
+                errors.append(err)
+            finally:
+                tasks.task_done()
+        tasks.task_done()
+
+    for _ in range1(workers):
+        Thread(target=run, daemon=True).start()
+    return dictToNspace(
+        {"put": tasks.put, "tasks": tasks, "errors": errors, "workers": workers}
+    )
+
+
+def stopWorker(worker):
+    for _ in range1(worker.workers):
+        worker.tasks.put(None)
+    worker.tasks.join()
+    if worker.errors:
+        raise worker.errors[0]
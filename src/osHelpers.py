@@ -1,11 +1,24 @@
-from json import loads
+from asyncio import create_subprocess_exec
+from collections import deque
+from fnmatch import translate
+from json import JSONDecodeError, dumps, loads
+from os import fsync, replace, scandir
 from pathlib import Path
+from re import compile as reCompile
 from shutil import which
-from subprocess import run
-from time import sleep
+from tempfile import mkstemp
+from subprocess import PIPE, CalledProcessError, Popen, run
+from threading import RLock, Thread
+from time import sleep, time, time_ns
 from traceback import format_exc
+from zlib import crc32
 
-from .pkgState import getLogFile
+from .helpers import readableSize, readableTime, round2, strSum
+from .pkgState import getCacheDir, getLogFile
+
+logLock = RLock()
+
+progressBoard = {"jobs": {}, "shown": 0, "width": 0}
 
 
 def exitIfEmpty(x):
@@ -14,7 +27,10 @@ def exitIfEmpty(x):
         exit()
 
 
-def waitN(n):
+def waitN(n, countdown=True):
+    if not countdown:
+        sleep(n)
+        return
     print("\n")
     for i in reversed(range(0, n)):
         print(
@@ -29,14 +45,101 @@ def checkExceptions(output):
         return o if not isinstance(o, Exception) else reportErr(o)
 
 
-def runCmd(cmd):
+def runCmd(cmd, ext=True):
     try:
         cmdOut = run(cmd, check=True, capture_output=True, text=True)
-        cmdOut = cmdOut.stdout
     except Exception as callErr:
-        reportErr(callErr)
-        # return callErr
-    return cmdOut
+        reportErr(callErr, ext)
+        raise
+    return cmdOut.stdout
+
+
+def parseProgress(progress):
+    toFloat = lambda v: float(v) if v and v != "N/A" else 0.0
+    return {
+        "outTime": max(toFloat(progress.get("out_time_us")) / 1e6, 0.0),
+        "frames": int(toFloat(progress.get("frame"))),
+        "fps": toFloat(progress.get("fps")),
+        "speed": toFloat(progress.get("speed", "").rstrip("x")),
+        "totalSize": int(toFloat(progress.get("total_size"))),
+    }
+
+
+statsSizes = reCompile(r"video:([\d.]+)(?:kB|KiB) audio:([\d.]+)(?:kB|KiB)")
+
+
+def parseStats(errLines):
+    # muxed stream sizes from ffmpeg's final stats report, logged at -loglevel 32;
+    # printed in KiB and rounded to whole KiB
+    for line in reversed(errLines):
+        found = statsSizes.search(line)
+        if found:
+            video, audio = (int(float(n) * 1024) for n in found.groups())
+            return {"videoSize": video, "audioSize": audio}
+    return {"videoSize": None, "audioSize": None}
+
+
+def progressLine(label, prog, duration=None):
+    line = (
+        f"{label}: {readableTime(prog['outTime'])}"
+        f" @ x{round2(prog['speed'])}, {round2(prog['fps'])} fps"
+        f", {readableSize(prog['totalSize'])}"
+    )
+    if duration and prog["speed"]:
+        eta = max(float(duration) - prog["outTime"], 0) / prog["speed"]
+        line = f"{line}, ETA {readableTime(eta)}"
+    return line
+
+
+def showProgress(label, line=None, every=1):
+    with logLock:
+        jobs = progressBoard["jobs"]
+        if line is None:
+            jobs.pop(label, None)
+        else:
+            jobs[label] = line
+        if line is not None and time() - progressBoard["shown"] < every:
+            return
+        board = " | ".join(jobs.values())
+        clearProgress()
+        print(board, end="", flush=True)
+        progressBoard["shown"], progressBoard["width"] = time(), len(board)
+
+
+def clearProgress():
+    if progressBoard["width"]:
+        print(f"\r{' ' * progressBoard['width']}\r", end="", flush=True)
+        progressBoard["width"] = 0
+
+
+def runCmdProgress(cmd, duration=None, label=None, tail=40, inp=None, ext=True):
+    # streams ffmpeg -progress output; keeps only the last lines of stderr
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    label = label or Path(cmd[-1]).name
+    errTail = deque(maxlen=tail)
+    progress = {}
+    stdin = PIPE if inp is not None else None
+    proc = Popen(
+        cmd, stdin=stdin, stdout=PIPE, stderr=PIPE, text=True, errors="replace"
+    )
+    errThread = Thread(target=errTail.extend, args=(proc.stderr,), daemon=True)
+    errThread.start()
+    if inp is not None:
+        proc.stdin.write(inp)
+        proc.stdin.close()
+    for line in proc.stdout:
+        key, _, val = line.strip().partition("=")
+        progress[key] = val
+        if key == "progress":
+            showProgress(label, progressLine(label, parseProgress(progress), duration))
+    proc.wait()
+    errThread.join()
+    showProgress(label)
+    if proc.returncode:
+        callErr = CalledProcessError(proc.returncode, cmd, stderr="".join(errTail))
+        reportErr(callErr, ext)
+        raise callErr
+    return {**parseProgress(progress), **parseStats(errTail)}
 
 
 def runCmdJson(cmd):
@@ -47,6 +150,14 @@ def runCmdJson(cmd):
     return data
 
 
+async def runCmdJsonAsync(cmd):
+    proc = await create_subprocess_exec(*cmd, stdout=PIPE, stderr=PIPE)
+    cmdOut, cmdErr = await proc.communicate()
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd, cmdOut, cmdErr.decode())
+    return loads(cmdOut)
+
+
 def checkPath(path, absPath=None):
     path = which(path)
     if path:
@@ -62,13 +173,95 @@ def checkPaths(paths):
         return [checkPath(p, ap) for p, ap in paths.items()]
 
 
-def getFileList(dirPath, exts, rec=False):
-    if rec:
-        return [f for f in dirPath.rglob("*.*") if f.suffix.lower() in exts]
-    else:
-        return [
-            f for f in dirPath.iterdir() if f.is_file() and f.suffix.lower() in exts
-        ]
+walkExcludes = ("out_*", "tests_*")
+
+racyNs = 2 * 10**9  # dirs changed this close to a snapshot are listed again
+
+
+def walkSnapFile(dirPath, exts, exclude, followLinks):
+    cacheDir = getCacheDir()
+    if cacheDir is None:
+        return None
+    key = dumps([str(dirPath), sorted(exts), sorted(exclude), followLinks])
+    return cacheDir / f"walk_{strSum(key)}.json"
+
+
+def readWalkSnap(snapFile):
+    try:
+        snap = loads(snapFile.read_text())
+        return (snap["taken"], snap["dirs"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return (0, {})
+
+
+def writeWalkSnap(snapFile, taken, dirs):
+    # a unique temp file per writer; concurrent walks of one tree just race replace
+    snapFile.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmpName = mkstemp(prefix=f".{snapFile.stem}_", dir=snapFile.parent)
+    try:
+        with open(fd, "w") as f:
+            f.write(dumps({"taken": taken, "dirs": dirs}, separators=(",", ":")))
+        replace(tmpName, snapFile)
+    except OSError:
+        removeFile(Path(tmpName))
+        raise
+
+
+def scanDir(dirPath, exts, skip, followLinks):
+    # raw names only; d_type from scandir avoids a stat per entry; skip only
+    # applies to directory names
+    files, subDirs = [], []
+    with scandir(dirPath) as entries:
+        for entry in entries:
+            name, dot = entry.name, entry.name.rfind(".")
+            try:
+                if entry.is_dir(follow_symlinks=followLinks):
+                    if not (skip and skip.match(name)):
+                        subDirs.append(name)
+                elif dot > 0 and name[dot:].lower() in exts and entry.is_file():
+                    files.append(name)
+            except OSError:
+                continue
+    return (files, subDirs)
+
+
+def iterFileList(dirPath, exts, rec=False, exclude=walkExcludes, followLinks=False):
+    # streams files as directories are listed; recursive walks reuse the last
+    # listing of every directory whose mtime is unchanged since the snapshot
+    exts = {e.lower() for e in exts}
+    skip = reCompile("|".join(translate(g) for g in exclude)) if exclude else None
+    snapFile = rec and walkSnapFile(dirPath, exts, exclude, followLinks)
+    taken, oldDirs = readWalkSnap(snapFile) if snapFile else (0, {})
+    started, newDirs, seen, stack = time_ns(), {}, set(), [dirPath]
+    relisted = 0
+    while stack:
+        path = stack.pop()
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        if (st.st_dev, st.st_ino) in seen:
+            continue  # symlink loop
+        seen.add((st.st_dev, st.st_ino))
+        listing = oldDirs.get(str(path))
+        if not (
+            listing and listing[0] == st.st_mtime_ns and st.st_mtime_ns < taken - racyNs
+        ):
+            try:
+                listing = [st.st_mtime_ns, *scanDir(path, exts, skip, followLinks)]
+            except OSError:
+                continue
+            relisted += 1
+        newDirs[str(path)] = listing
+        yield from (path / name for name in listing[1])
+        if rec:
+            stack.extend(path / name for name in reversed(listing[2]))
+    if snapFile and (relisted or len(newDirs) != len(oldDirs)):
+        writeWalkSnap(snapFile, started, newDirs)
+
+
+def getFileList(dirPath, exts, rec=False, exclude=walkExcludes, followLinks=False):
+    return list(iterFileList(dirPath, exts, rec, exclude, followLinks))
 
 
 def removeFile(file):
@@ -111,16 +304,76 @@ def makeTargetDirs(dirPath, names=None):
 def appendFile(file, contents):
     # if not file.exists():
     #     file.touch()
-    with open(file, "a") as f:
+    # undecodable file names arrive as surrogates; keep them readable
+    with open(file, "a", errors="backslashreplace") as f:
         f.write(str(contents))
 
 
+def fileCrc(file, bufSize=1 << 20):
+    crc = 0
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(bufSize), b""):
+            crc = crc32(chunk, crc)
+    return crc
+
+
+def moveVerified(src, dst, bufSize=1 << 20):
+    # copy next to dst, re-read to verify, then atomically replace dst
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if src.stat().st_dev == dst.parent.stat().st_dev:
+        replace(src, dst)
+        return dst
+    partFile = dst.with_name(f".part_{dst.name}")
+    crc = 0
+    with open(src, "rb") as fin, open(partFile, "wb") as fout:
+        for chunk in iter(lambda: fin.read(bufSize), b""):
+            crc = crc32(chunk, crc)
+            fout.write(chunk)
+        fout.flush()
+        fsync(fout.fileno())
+    if fileCrc(partFile) != crc:
+        removeFile(partFile)
+        raise OSError(f"Copy of {src} to {dst} failed verification.")
+    replace(partFile, dst)
+    removeFile(src)
+    return dst
+
+
+def appendJsonl(file, data):
+    with open(file, "a") as f:
+        f.write(f"{dumps(data)}\n")
+        f.flush()
+        fsync(f.fileno())
+
+
+def readJsonl(file):
+    if not file.exists():
+        return
+    with open(file) as f:
+        for line in f:
+            try:
+                yield loads(line)
+            except JSONDecodeError:
+                continue  # torn line from an interrupted write
+
+
+def jsonToJsonl(jsonFile, jsonlFile):
+    data = loads(jsonFile.read_text())
+    with open(jsonlFile, "a") as f:
+        f.writelines(f"{dumps(d)}\n" for d in data)
+        f.flush()
+        fsync(f.fileno())
+    return len(data)
+
+
 def log(msg):  # prefix="[lvl] now(): msg"
     msg = str(msg)
     logFile = getLogFile()
-    print(msg)
-    if logFile:
-        appendFile(logFile, f"{msg}\n")
+    with logLock:
+        clearProgress()
+        print(msg)
+        if logFile:
+            appendFile(logFile, f"{msg}\n")
 
 
 # def logWarn(), logError()
@@ -128,13 +381,14 @@ def log(msg):  # prefix="[lvl] now(): msg"
 
 
 def reportErr(exp=None, ext=True):
-    log("\n------\nERROR: Something went wrong.")
-    if exp and exp.stderr:
-        log(f"\nStdErr: {exp.stderr}\nReturn Code: {exp.returncode}")
-    if exp:
-        log(
-            f"\nException:\n{exp}\n\nAdditional Details:\n{format_exc()}",
-        )
+    with logLock:
+        log("\n------\nERROR: Something went wrong.")
+        if getattr(exp, "stderr", None):
+            log(f"\nStdErr: {exp.stderr}\nReturn Code: {exp.returncode}")
+        if exp:
+            log(
+                f"\nException:\n{exp}\n\nAdditional Details:\n{format_exc()}",
+            )
     if ext:
         exit()
 
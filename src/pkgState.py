@@ -1,7 +1,13 @@
+from os import environ
 from pathlib import Path
 
 logFile = None
 
+cacheDir = Path(
+    environ.get("FFU_CACHE_DIR")
+    or Path(environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "ffUtils"
+)
+
 
 def setLogFile(lf):
     global logFile
@@ -9,4 +15,12 @@ def setLogFile(lf):
     return logFile
 
 
+def setCacheDir(cd):
+    global cacheDir
+    cacheDir = Path(cd) if cd else None
+    return cacheDir
+
+
 getLogFile = lambda: logFile
+
+getCacheDir = lambda: cacheDir
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+from functools import wraps
+from os import replace
+from time import perf_counter, time
+
+from .helpers import round2
+
+
+class StageTimer:
+    __slots__ = ("stages",)
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        strt = perf_counter()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + perf_counter() - strt
+
+    def timed(self, name):
+        def wrapper(func):
+            @wraps(func)
+            def inner(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+
+            return inner
+
+        return wrapper
+
+    def toDict(self):
+        return {k: round(v, 4) for k, v in self.stages.items()}
+
+
+stagePrefix = "stage."
+
+stageKeys = lambda stages: {f"{stagePrefix}{k}": v for k, v in stages.items()}
+
+statStages = lambda stats: {
+    k[len(stagePrefix) :]: s
+    for k, s in stats.stats.items()
+    if k.startswith(stagePrefix)
+}
+
+
+def readableStages(stats):
+    return {name: f"{s.mean:.3f}s" for name, s in statStages(stats).items() if s.count}
+
+
+promLabels = lambda **lbls: ",".join(f'{k}="{v}"' for k, v in lbls.items())
+
+
+def promMetric(name, typ, desc, samples):
+    # samples are (suffix, labels, value)
+    return [
+        f"# HELP {name} {desc}",
+        f"# TYPE {name} {typ}",
+        *(f"{name}{sfx}{{{lbls}}} {val}" for sfx, lbls, val in samples),
+    ]
+
+
+def promText(tool, stats, files, failed=None):
+    toolLbl = promLabels(tool=tool)
+    stages = [
+        (promLabels(tool=tool, stage=name), s) for name, s in statStages(stats).items()
+    ]
+    lines = [
+        *promMetric(
+            "ffu_stage_seconds",
+            "summary",
+            "Time spent in each processing stage.",
+            [
+                *(("_sum", lbls, s.total) for lbls, s in stages),
+                *(("_count", lbls, s.count) for lbls, s in stages),
+            ],
+        ),
+        *promMetric(
+            "ffu_stage_seconds_max",
+            "gauge",
+            "Slowest single run of each stage.",
+            [("", lbls, s.high or 0) for lbls, s in stages],
+        ),
+        *promMetric(
+            "ffu_files_total",
+            "counter",
+            "Files processed by the current run.",
+            [("", toolLbl, files)],
+        ),
+    ]
+    if failed is not None:
+        lines += promMetric(
+            "ffu_files_failed_total",
+            "counter",
+            "Files that failed in the current run.",
+            [("", toolLbl, failed)],
+        )
+    lines += promMetric(
+        "ffu_last_update_timestamp_seconds",
+        "gauge",
+        "Time of the last update.",
+        [("", toolLbl, round2(time()))],
+    )
+    return "\n".join(lines) + "\n"
+
+
+def writeProm(promFile, tool, stats, files, failed=None):
+    # node_exporter may read at any time; only ever expose a complete file
+    tmpFile = promFile.with_name(f".{promFile.name}.tmp")
+    tmpFile.write_text(promText(tool, stats, files, failed))
+    replace(tmpFile, promFile)
+    return promFile
@@ -0,0 +1,93 @@
+from collections import Counter
+from random import Random
+
+
+class RunningStat:
+    __slots__ = ("count", "total", "low", "high")
+
+    def __init__(self, count=0, total=0.0, low=None, high=None):
+        self.count = count
+        self.total = total
+        self.low = low
+        self.high = high
+
+    def add(self, val):
+        if val is None or val == "":
+            return self
+        val = float(val)
+        self.count += 1
+        self.total += val
+        self.low = val if self.low is None else min(self.low, val)
+        self.high = val if self.high is None else max(self.high, val)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def toDict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class RunStats:
+    __slots__ = ("stats",)
+
+    def __init__(self, data=None):
+        self.stats = {k: RunningStat(**v) for k, v in (data or {}).items()}
+
+    def __getitem__(self, key):
+        return self.stats.setdefault(key, RunningStat())
+
+    def add(self, **vals):
+        for k, v in vals.items():
+            self[k].add(v)
+        return self
+
+    def toDict(self):
+        return {k: s.toDict() for k, s in self.stats.items()}
+
+
+class StreamMode:
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, val):
+        if val is not None:
+            self.counts[val] += 1
+        return self
+
+    @property
+    def mode(self):
+        return self.counts.most_common(1)[0][0] if self.counts else None
+
+
+class Reservoir:
+    # fixed size uniform sample of the stream for approximate quantiles
+    __slots__ = ("size", "seen", "sample", "rng")
+
+    def __init__(self, size=4096, seed=0):
+        self.size = size
+        self.seen = 0
+        self.sample = []
+        self.rng = Random(seed)
+
+    def add(self, val):
+        if val is None or val == "":
+            return self
+        self.seen += 1
+        if len(self.sample) < self.size:
+            self.sample.append(float(val))
+        else:
+            idx = self.rng.randrange(self.seen)
+            if idx < self.size:
+                self.sample[idx] = float(val)
+        return self
+
+    def quantiles(self, qs=(0.1, 0.5, 0.9)):
+        srtd = sorted(self.sample)
+        if not srtd:
+            return [0.0 for _ in qs]
+        last = len(srtd) - 1
+        return [srtd[round(q * last)] for q in qs]
@@ -0,0 +1,95 @@
+import os
+from os import cpu_count
+from pathlib import Path
+from time import sleep
+
+from .helpers import dictToNspace, round2
+
+thermalDir = Path("/sys/class/thermal")
+
+
+def loadAvg():
+    try:
+        # os.getloadavg does not exist on Windows
+        return os.getloadavg()[0] / (cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def cpuTimes():
+    try:
+        with open("/proc/stat") as f:
+            vals = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    return (vals[3] + vals[4], sum(vals))  # idle + iowait, total
+
+
+def cpuBusy(interval=0.5):
+    start = cpuTimes()
+    if start is None:
+        return None
+    sleep(interval)
+    end = cpuTimes()
+    idle, total = end[0] - start[0], end[1] - start[1]
+    return 1 - idle / total if total else None
+
+
+def cpuTemp():
+    temps = []
+    for zone in thermalDir.glob("thermal_zone*/temp"):
+        try:
+            temps.append(int(zone.read_text()) / 1000)
+        except (OSError, ValueError):
+            continue
+    return max(temps) if temps else None
+
+
+def freeMem():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def throttleCfg(maxLoad=1.0, maxTemp=85, minMem=512, maxWait=600):
+    return dictToNspace(locals())
+
+
+def overLimits(cfg, own=0.0):
+    # own: load per core expected from this run's own encodes, not throttled on
+    reasons = []
+
+    load = loadAvg()
+    if load is not None and load - own > cfg.maxLoad:
+        # load average lags; only back off if the cpu is still busy right now
+        busy = cpuBusy()
+        if busy is None or busy > 0.9:
+            reasons.append(f"load {round2(load)}/core")
+
+    temp = cpuTemp()
+    if temp is not None and temp > cfg.maxTemp:
+        reasons.append(f"temperature {round2(temp)}C")
+
+    mem = freeMem()
+    if mem is not None and mem < cfg.minMem * 1024 * 1024:
+        reasons.append(f"free memory {mem // (1024 * 1024)}MB")
+
+    return reasons
+
+
+def throttle(cfg, step=5, maxStep=60, report=print, own=lambda: 0.0):
+    waited = 0
+    reasons = overLimits(cfg, own())
+    if reasons:
+        report(f"\nThrottling: {', '.join(reasons)}.")
+    while reasons and waited < cfg.maxWait:
+        sleep(step)
+        waited += step
+        step = min(step * 2, maxStep)
+        reasons = overLimits(cfg, own())
+    return waited
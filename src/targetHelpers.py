@@ -0,0 +1,90 @@
+from .ffHelpers import (
+    calcSplits,
+    crfRanges,
+    ffmpegSamplesCmd,
+    getffmpegCmd,
+    getKeyframes,
+    getMetrics,
+    optsVideo,
+    samplesList,
+    selectCodec,
+)
+from .helpers import dictToNspace
+from .osHelpers import removeFile, runCmdProgress
+
+searchBudget = 0.1  # share of the source duration all search encodes may take
+
+
+def samplePlan(duration, samples, length, steps):
+    # (count, length) of >= 1s samples whose encodes over every search step stay
+    # within searchBudget; count is 0 for files too short to search
+    total = min(samples * length, float(duration or 0) * searchBudget / steps)
+    count = min(samples, int(total))
+    return (count, total / count) if count else (0, 0)
+
+
+def takeSample(ffPaths, file, duration, plan, sampleFile):
+    ffprobePath, ffmpegPath = ffPaths
+    count, length = plan
+    splits = calcSplits(duration, count, length)
+    starts = getKeyframes(ffprobePath, file, [max(s, 0) for s in splits], False)
+    runCmdProgress(
+        ffmpegSamplesCmd(ffmpegPath, sampleFile),
+        length * len(starts),
+        f"{file.name} [samples]",
+        inp=samplesList(file, starts, length),
+        ext=False,
+    )
+    return length * len(starts)
+
+
+def scoreCrf(ffmpegPath, sampleFile, video, videoMeta, crf, cfg, duration):
+    encFile = sampleFile.with_name(f"crf{crf}_{sampleFile.name}")
+    opts = [
+        *selectCodec(video.codec, crf, video.speed),
+        *optsVideo(videoMeta.height, videoMeta.fps, video.res, video.fps),
+        "-an",
+    ]
+    try:
+        runCmdProgress(
+            getffmpegCmd(ffmpegPath, sampleFile, encFile, opts),
+            duration,
+            f"{sampleFile.name} [crf {crf}]",
+            ext=False,
+        )
+        return getMetrics(ffmpegPath, sampleFile, encFile, cfg, duration, False)["vmaf"]
+    finally:
+        removeFile(encFile)
+
+
+def searchCrf(ffPaths, file, metas, video, cfg, sampleFile):
+    # highest crf whose samples still reach the target vmaf; None when the file
+    # is too short to search within searchBudget
+    fmtMeta, videoMeta = metas
+    vmafCfg = dictToNspace(
+        {
+            "metrics": ["vmaf"],
+            "metricThreads": cfg.metricThreads,
+            "subsample": cfg.subsample,
+        }
+    )
+    low, high = crfRanges[video.codec]
+    steps = (high - low + 1).bit_length()
+    plan = samplePlan(fmtMeta.duration, cfg.targetSamples, cfg.targetLength, steps)
+    if not plan[0]:
+        return None
+    best, scores = low, {}
+    try:
+        duration = takeSample(ffPaths, file, fmtMeta.duration, plan, sampleFile)
+        while low <= high:
+            crf = (low + high) // 2
+            scores[crf] = scoreCrf(
+                ffPaths[1], sampleFile, video, videoMeta, crf, vmafCfg, duration
+            )
+            if scores[crf] >= cfg.targetVmaf:
+                best, low = crf, crf + 1
+            else:
+                high = crf - 1
+    finally:
+        removeFile(sampleFile)
+    return (best, scores)
@@ -0,0 +1,141 @@
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import close, fsdecode, fsencode, read, strerror
+from pathlib import Path
+from select import select
+from struct import Struct
+from time import sleep, time
+
+from .osHelpers import iterFileList, log
+
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x8, 0x80, 0x100
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+IN_CLOEXEC = 0o2000000
+
+watchMask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+eventHead = Struct("iIII")  # wd, mask, cookie, len
+
+
+def loadInotify():
+    try:
+        libc = CDLL(find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError) as libErr:
+        raise OSError(f"inotify is not available: {libErr}")
+    return libc
+
+
+class Inotify:
+    __slots__ = ("libc", "fd", "dirs")
+
+    def __init__(self):
+        self.libc = loadInotify()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+        self.dirs = {}
+
+    def add(self, dirPath):
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(dirPath), watchMask)
+        if wd < 0:
+            # ENOSPC once fs.inotify.max_user_watches is used up
+            raise OSError(get_errno(), f"{strerror(get_errno())}: {dirPath}")
+        self.dirs[wd] = dirPath
+
+    def read(self, timeout):
+        # (path, mask) pairs; empty when nothing happened within timeout
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        data, events, pos = read(self.fd, 1 << 16), [], 0
+        while pos < len(data):
+            wd, mask, _, nameLen = eventHead.unpack_from(data, pos)
+            name = data[pos + eventHead.size : pos + eventHead.size + nameLen]
+            pos += eventHead.size + nameLen
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+            elif wd in self.dirs or mask & IN_Q_OVERFLOW:
+                path = self.dirs.get(wd, Path())
+                events.append((path / fsdecode(name.rstrip(b"\0")), mask))
+        return events
+
+    def close(self):
+        close(self.fd)
+
+
+isExcluded = lambda path, exclude: any(d == path or d in path.parents for d in exclude)
+
+
+def subDirs(dirPath, exclude):
+    return [d for d in dirPath.rglob("*") if d.is_dir() and not isExcluded(d, exclude)]
+
+
+def settledFiles(pending, settle):
+    # files whose size and mtime have not changed for settle seconds
+    ready, tick = [], time()
+    for file, last in list(pending.items()):
+        try:
+            st = file.stat()
+        except OSError:
+            del pending[file]  # deleted or moved away before it settled
+            continue
+        sig = (st.st_size, st.st_mtime_ns)
+        if last is None or last[0] != sig:
+            pending[file] = (sig, tick)
+        elif st.st_size and tick - last[1] >= settle:
+            ready.append(file)
+            del pending[file]
+    return ready
+
+
+def watchFiles(dirPath, exts, rec, skip, exclude, settle, interval, walk, poll=False):
+    # yields a (possibly empty) list of newly settled files every tick, forever;
+    # walk is (exclude globs, followLinks) for the directory scans
+    pending, seen = {}, set(skip)
+
+    def track(file):
+        if (
+            file.suffix.lower() in exts
+            and str(file) not in seen
+            and file not in pending
+            and not isExcluded(file, exclude)
+        ):
+            pending[file] = None
+
+    def scan(path):
+        for file in iterFileList(path, exts, rec, *walk):
+            track(file)
+
+    ino = None
+    if not poll:
+        try:
+            ino = Inotify()
+            for d in [dirPath, *(subDirs(dirPath, exclude) if rec else [])]:
+                ino.add(d)
+        except OSError as inoErr:
+            log(f"WARNING: {inoErr}; polling every {interval} second(s) instead.")
+            ino = ino and ino.close()
+
+    scan(dirPath)  # anything that arrived while nothing was watching
+    while True:
+        if ino:
+            try:
+                for path, mask in ino.read(interval):
+                    if mask & IN_Q_OVERFLOW:
+                        scan(dirPath)
+                    elif mask & IN_ISDIR:
+                        if rec and not isExcluded(path, exclude):
+                            for d in [path, *subDirs(path, exclude)]:
+                                ino.add(d)
+                            scan(path)
+                    else:
+                        track(path)
+            except OSError as inoErr:
+                log(f"WARNING: {inoErr}; polling every {interval} second(s) now.")
+                ino = ino.close()
+        else:
+            sleep(interval)
+            scan(dirPath)
+        ready = settledFiles(pending, settle)
+        seen.update(str(f) for f in ready)
+        yield ready
@@ -1,9 +1,37 @@
 from argparse import ArgumentParser
-
-from src.cliHelpers import addCliDir, addCliExt, addCliOnly, addCliRec
-from src.ffHelpers import ffmpegConcatCmd, ffmpegTrimCmd, getFormatKeys, getMetaData
-from src.helpers import emap, range1, strSum
-from src.osHelpers import checkPaths, exitIfEmpty, getFileList, removeFiles, runCmd
+from time import time
+
+from src.cliHelpers import (
+    addCliDir,
+    addCliExt,
+    addCliJobs,
+    addCliOnly,
+    addCliProbeJobs,
+    addCliProm,
+    addCliRec,
+)
+from src.ffHelpers import (
+    calcSplits,
+    ffmpegConcatCmd,
+    ffmpegSamplesCmd,
+    ffmpegTrimCmd,
+    getFormatKeys,
+    getKeyframes,
+    probeFiles,
+    samplesList,
+)
+from src.helpers import readableDict, readableTime, round2, strSum
+from src.jobHelpers import defaultJobs, isolate, poolMap
+from src.osHelpers import (
+    checkPaths,
+    exitIfEmpty,
+    getFileList,
+    log,
+    removeFiles,
+    runCmdProgress,
+)
+from src.stageHelpers import StageTimer, readableStages, stageKeys, writeProm
+from src.statHelpers import RunStats
 
 
 def cliArgs(parser):
@@ -11,6 +39,9 @@ def cliArgs(parser):
     parser = addCliRec(parser)
     parser = addCliExt(parser, (".mp4", ".mov"))
     parser = addCliOnly(parser)
+    parser = addCliProbeJobs(parser)
+    parser = addCliJobs(parser, defaultJobs(2))
+    parser = addCliProm(parser)
     parser.add_argument(
         "-l",
         "--length",
@@ -25,60 +56,116 @@ def cliArgs(parser):
         type=int,
         help="Number of samples samples.",
     )
+    parser.add_argument(
+        "-lg",
+        "--legacy",
+        action="store_true",
+        help="Trim each sample to a temporary file and concatenate them afterwards.",
+    )
     return parser
 
 
-def calcSplits(secs, splits, length):
-    s = float(secs) / splits
-    return [(s * i - length * i) for i in range1(splits)]
-
-
 def makeSplits(ffmpegPath, file, splits, length):
     outFiles = []
-    nameSum = strSum(file.name)
+    nameSum = strSum(str(file))
     for i, s in enumerate(splits, start=1):
         outFile = file.with_stem(f"tmp_{nameSum}_{i}")
-        runCmd(ffmpegTrimCmd(ffmpegPath, file, outFile, s, length))
+        trimCmd = ffmpegTrimCmd(ffmpegPath, file, outFile, s, length)
+        runCmdProgress(trimCmd, length, f"{file.name} [{i}]", ext=False)
         outFiles = [*outFiles, outFile]
     concat = "\n".join([f"file '{f}'" for f in outFiles])
-    splitsFile = file.with_suffix(".splits")
+    splitsFile = file.with_name(f"tmp_{nameSum}.splits")
     splitsFile.write_text(concat)
     return (splitsFile, outFiles)
 
 
 def concatSplits(ffmpegPath, splitsFile, tmpFiles, outFile):
-    runCmd(ffmpegConcatCmd(ffmpegPath, splitsFile, outFile))
+    runCmdProgress(ffmpegConcatCmd(ffmpegPath, splitsFile, outFile), ext=False)
     removeFiles([splitsFile, *tmpFiles])
 
 
-def mainLoop(file, pargs, ffmpegPath, ffprobePath):
+def takeSplits(ffPaths, file, splits, length, outFile, timer):
+    ffprobePath, ffmpegPath = ffPaths
+    with timer.stage("keyframes"):
+        starts = getKeyframes(ffprobePath, file, [max(s, 0) for s in splits], False)
+    with timer.stage("samples"):
+        runCmdProgress(
+            ffmpegSamplesCmd(ffmpegPath, outFile),
+            length * len(starts),
+            file.name,
+            inp=samplesList(file, starts, length),
+            ext=False,
+        )
+
+
+def mainLoop(file, metaData, pargs, ffPaths):
+    timer = StageTimer()
     outFile = file.with_name(f"trm_{file.name}")  # outfiles?
-    metaData = getMetaData(ffprobePath, file)
     duration = getFormatKeys(metaData, "duration")
     splits = calcSplits(duration, pargs.samples, pargs.length)
-    splitsFile, tmpFiles = makeSplits(ffmpegPath, file, splits, pargs.length)
-    concatSplits(ffmpegPath, splitsFile, tmpFiles, outFile)
+    if pargs.legacy:
+        ffmpegPath = ffPaths[1]
+        with timer.stage("trim"):
+            splitsFile, tmpFiles = makeSplits(ffmpegPath, file, splits, pargs.length)
+        with timer.stage("concat"):
+            concatSplits(ffmpegPath, splitsFile, tmpFiles, outFile)
+    else:
+        takeSplits(ffPaths, file, splits, pargs.length, outFile, timer)
+    return {"size": file.stat().st_size, "stages": timer.toDict()}
+
+
+def getSummary(done, failed, inBytes, timeTaken, stats):
+    return (
+        f"\nSampled {done} file(s), {failed} failed, in {readableTime(timeTaken)}."
+        f"\nThroughput:: Files: {round2(done / timeTaken)}/s"
+        f" & Input: {round2(inBytes / timeTaken / 1024**3)} GB/s."
+        f"\nStage averages:: {readableDict(readableStages(stats))}"
+    )
 
 
 def main(pargs):
 
-    ffprobePath, ffmpegPath = checkPaths(
+    ffPaths = checkPaths(
         {
             "ffprobe": r"D:\PortableApps\bin\ffprobe.exe",
             "ffmpeg": r"D:\PortableApps\bin\ffmpeg.exe",
         }
     )
 
-    fileList = getFileList(pargs.dir.resolve(), pargs.extensions, pargs.recursive)
+    fileList = getFileList(
+        pargs.dir.resolve(),
+        pargs.extensions,
+        pargs.recursive,
+        pargs.exclude,
+        pargs.followLinks,
+    )
 
     exitIfEmpty(fileList)
 
     if pargs.only:
         fileList = fileList[: pargs.only]
 
-    mainLoopP = lambda f: mainLoop(f, pargs, ffmpegPath, ffprobePath)
-
-    emap(mainLoopP, fileList)
+    def mainLoopP(probed):
+        file, metaData = probed
+        if isinstance(metaData, Exception):
+            log(f"WARNING: Failed to probe {file}: {metaData}")
+            return (None, metaData)
+        return isolate(mainLoop, file, metaData, pargs, ffPaths)
+
+    strtTime = time()
+    stats, inBytes, done, failed = RunStats(), 0, 0, 0
+    probed = probeFiles(ffPaths[0], fileList, pargs.probeJobs)
+    for res, err in poolMap(mainLoopP, probed, pargs.jobs):
+        if err:
+            failed += 1
+        else:
+            done, inBytes = done + 1, inBytes + res["size"]
+            stats.add(**stageKeys(res["stages"]))
+        if pargs.prom:
+            writeProm(pargs.prom, "takeSamples", stats, done, failed)
+    timeTaken = max(time() - strtTime, 1e-6)
+
+    log(getSummary(done, failed, inBytes, timeTaken, stats))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+
+from __main__ import __file__ as mainFile
+
+from optimizeAV import cliArgs as cliOav
+from optimizeAV import effLine, loadJournal, newRunState, runFiles, runPaths
+from src.cacheHelpers import cacheSummary
+from src.ffHelpers import audioCfg, videoCfg
+from src.helpers import now
+from src.osHelpers import appendJsonl, checkPaths, log, readJsonl
+from src.pkgState import setLogFile
+from src.watchHelpers import watchFiles
+
+
+def cliArgs(parser):
+    parser = cliOav(parser)
+    parser.add_argument(
+        "-st",
+        "--settle",
+        default=10,
+        type=float,
+        help="Seconds a new file's size must stay unchanged before it is "
+        "queued, so partial uploads are never encoded. (default: 10)",
+    )
+    parser.add_argument(
+        "-pi",
+        "--pollInterval",
+        default=2,
+        type=float,
+        help="Seconds between settle checks, and between rescans when "
+        "polling. (default: 2)",
+    )
+    parser.add_argument(
+        "-po",
+        "--poll",
+        action="store_true",
+        help="Poll the directory instead of using inotify; needed for network "
+        "mounts, and used automatically where inotify is not available.",
+    )
+    return parser
+
+
+def main(pargs):
+    ffPaths = checkPaths(
+        {
+            "ffprobe": r"D:\PortableApps\bin\ffprobe.exe",
+            "ffmpeg": r"D:\PortableApps\bin\ffmpeg.exe",
+        }
+    )
+
+    dirPath = pargs.dir.resolve()
+    outDir, _, addFiles = runPaths(dirPath, pargs)
+    tmpFile, logFile, jrnlFile = addFiles
+    queueFile = outDir / f"queue_{dirPath.name}.jsonl"
+
+    # the queue file lists every accepted and every failed file; the journal
+    # those done; failed files are not retried until their record is removed
+    stats, processed = loadJournal(jrnlFile)
+    records = list(readJsonl(queueFile))
+    queued = {rcd["file"] for rcd in records if "queued" in rcd}
+    failed = {rcd["file"] for rcd in records if "failed" in rcd}
+    pending = sorted(queued - processed - failed)
+
+    setLogFile(logFile)
+    log(f"\n\n=== {Path(mainFile).stem} Started at {now()} ===\n")
+
+    video = videoCfg(pargs.cVideo, pargs.qVideo, pargs.speed, pargs.res, pargs.fps)
+    audio = audioCfg(pargs.cAudio, pargs.qAudio)
+    runState = newRunState(stats, 0, pargs)
+    feed = Queue()
+
+    def enqueue(file):
+        with runState.lock:
+            runState.totalFiles += 1
+        feed.put((file, outDir / file.relative_to(dirPath)))
+
+    def fileFailed(file, fileErr):
+        if runState.stop.is_set():
+            # most likely ffmpeg killed by the same Ctrl+C; left queued to resume
+            log(f"WARNING: Interrupted file: {file.name}, resumes on restart.")
+            return
+        # reportErr has already logged the details before exiting
+        reason = "see the error above" if isinstance(fileErr, SystemExit) else fileErr
+        appendJsonl(
+            queueFile, {"file": str(file), "failed": now(), "error": str(reason)}
+        )
+        log(f"WARNING: Failed file: {file.name}, skipped; {reason}.")
+
+    for file in pending:
+        enqueue(Path(file))
+    if pending:
+        log(f"Resuming {len(pending)} queued file(s).")
+
+    # one long running optimizeAV pipeline fed by the watcher
+    feedItr = iter(feed.get, None)
+    pipe = Thread(
+        target=runFiles,
+        args=(feedItr, runState, addFiles, (audio, video), ffPaths, pargs, fileFailed),
+        daemon=True,
+    )
+    pipe.start()
+
+    watcher = watchFiles(
+        dirPath,
+        pargs.extensions,
+        pargs.recursive,
+        queued | processed,
+        [outDir, tmpFile.parent],
+        pargs.settle,
+        pargs.pollInterval,
+        (pargs.exclude, pargs.followLinks),
+        pargs.poll,
+    )
+    log(f"Watching {dirPath} for new files; press Ctrl+C to stop.")
+    try:
+        for ready in watcher:
+            for file in ready:
+                appendJsonl(queueFile, {"file": str(file), "queued": now()})
+                enqueue(file)
+                log(f"Queued file: {file.name}")
+            if not pipe.is_alive():
+                log("\nERROR: Encoding stopped; queued files resume on restart.")
+                exit(1)
+    except KeyboardInterrupt:
+        # no new files are taken; running encodes finish and are journaled
+        log("\nStopping; waiting for running encodes to finish.")
+        runState.stop.set()
+        feed.put(None)
+        pipe.join()
+        log(
+            f"\nStopped watching at {now()}; queued files resume on restart."
+            f"{effLine(runState.stats, pargs.jobs)}\n{cacheSummary()}"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Watch a directory and optimize new Video/Audio files as they "
+        "arrive."
+    )
+    main(cliArgs(parser).parse_args())